@@ -0,0 +1,177 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+import numpy as np
+import ephemeris_source
+import observer_geometry
+import roo_vs_ephemeris
+import sp3_cache
+import timeutils
+
+# Benchmark of the astropy, skyfield and precomputed comparison backends
+# Synthetic telescope tracks are generated from an SP3 file in qzr_ephemeris/ (the ephemeris RA/DEC plus noise),
+# then both backends are run through the same pipeline stages at each sample size:
+#   sp3_load      - parse the SP3 file into an empty cache and build the interpolator
+#   interpolation - Lagrange interpolation of the track at every telescope timestamp
+#   transform     - ITRS -> topocentric RA/DEC
+#   results_write - writing the comparison to the results store
+# Wall/CPU time per stage comes from a plain run, peak memory per stage from a second run under tracemalloc.
+# Results (plus each backend's max RA/DEC disagreement with astropy) are saved as JSON so runs can be diffed.
+# The precomputed backend's per-night rotation tables are built during the warm up, like the IERS tables.
+
+sp3_file = "qzr_ephemeris/qzf21993.sp3"
+satellite = roo_vs_ephemeris.QZS3
+sample_sizes = [1000, 10000, 100000]
+backends = ["astropy", "skyfield", "precomputed"]
+output_folder = "benchmark_results/"
+noise = 1.0 # Noise (arcsec) added to the synthetic telescope RA/DEC
+seed = 42
+
+def code_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def package_versions():
+    versions = {"python": platform.python_version(), "numpy": np.__version__}
+    for package in ["astropy", "skyfield", "pandas"]:
+        try:
+            versions[package] = __import__(package).__version__
+        except ImportError:
+            versions[package] = None
+    return versions
+
+# Evenly spaced telescope timestamps (away from the ends of the SP3 file) and noisy RA/DEC from the astropy backend
+def synthetic_track(no_samples):
+    satellite_time_gps, satellite_itrs = sp3_cache.load_ephemeris(sp3_file, satellite)
+    start = timeutils.gps_to_utc(satellite_time_gps[4])
+    span = satellite_time_gps[-5] - satellite_time_gps[4]
+    telescope_datetime = start + (np.arange(no_samples) * (span / no_samples)).astype('timedelta64[ns]') + np.timedelta64(123456, 'us')
+
+    interpolator = roo_vs_ephemeris.track_interpolator(sp3_file, satellite)
+    x_interp, y_interp, z_interp = roo_vs_ephemeris.interpolate(interpolator, telescope_datetime)
+    ra, dec = roo_vs_ephemeris.transform_batch(x_interp, y_interp, z_interp, telescope_datetime, roo_vs_ephemeris.get_obs_location())
+    rng = np.random.default_rng(seed)
+    telescope_ra = ra + rng.normal(0, noise / 3600, no_samples)
+    telescope_dec = dec + rng.normal(0, noise / 3600, no_samples)
+    return telescope_datetime, telescope_ra, telescope_dec
+
+class StageTimer:
+    def __init__(self, trace_memory):
+        self.trace_memory = trace_memory
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.trace_memory:
+            tracemalloc.start()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            result = {"wall_s": time.perf_counter() - wall, "cpu_s": time.process_time() - cpu}
+            if self.trace_memory:
+                result["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 1e6
+                tracemalloc.stop()
+            self.stages[name] = result
+
+def run_pipeline(backend, telescope_datetime, telescope_ra, telescope_dec, work_dir, trace_memory=False):
+    timer = StageTimer(trace_memory)
+    backend_transform_batch, obs_location = roo_vs_ephemeris.backend_transform(backend)
+
+    # Cold SP3 load: empty cache folder and in-process caches
+    sp3_cache.cache_folder = tempfile.mkdtemp(dir=work_dir, prefix="sp3_cache_") + "/"
+    sp3_cache._load_track.cache_clear()
+    ephemeris_source.merged_track.cache_clear()
+    roo_vs_ephemeris.track_interpolator.cache_clear()
+    with timer.stage("sp3_load"), contextlib.redirect_stdout(io.StringIO()):
+        interpolator = roo_vs_ephemeris.track_interpolator(sp3_file, satellite)
+    with timer.stage("interpolation"):
+        x_interp, y_interp, z_interp = roo_vs_ephemeris.interpolate(interpolator, telescope_datetime)
+    with timer.stage("transform"):
+        ephemeris_ra, ephemeris_dec = backend_transform_batch(x_interp, y_interp, z_interp, telescope_datetime, obs_location)
+    with timer.stage("results_write"), contextlib.redirect_stdout(io.StringIO()):
+        roo_vs_ephemeris.write_comparison(work_dir + "/results/", "benchmark_" + backend + ".csv", satellite, 0, telescope_datetime, telescope_ra, telescope_dec, ephemeris_ra, ephemeris_dec)
+
+    return timer.stages, np.asarray(ephemeris_ra), np.asarray(ephemeris_dec)
+
+def benchmark(sizes, output_file=None):
+    results = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "code_version": code_version(),
+        "versions": package_versions(),
+        "machine": {"platform": platform.platform(), "processor": platform.processor(), "cpus": os.cpu_count()},
+        "sp3_file": sp3_file,
+        "satellite": satellite,
+        "runs": [],
+    }
+    cache_folder, observer_cache_folder = sp3_cache.cache_folder, observer_geometry.cache_folder
+    with tempfile.TemporaryDirectory() as work_dir:
+        sp3_cache.cache_folder = work_dir + "/sp3_cache/"
+        observer_geometry.cache_folder = work_dir + "/observer_cache/"
+        # Warm up both backends (IERS/leap second tables, lazy imports) so the first timed run isn't penalised
+        warmup = synthetic_track(10)
+        for backend in backends:
+            run_pipeline(backend, *warmup, work_dir)
+
+        for no_samples in sizes:
+            track = synthetic_track(no_samples)
+            radec = {}
+            for backend in backends:
+                stages, ephemeris_ra, ephemeris_dec = run_pipeline(backend, *track, work_dir)
+                memory_stages, _, _ = run_pipeline(backend, *track, work_dir, trace_memory=True)
+                for name in stages:
+                    stages[name]["peak_memory_mb"] = memory_stages[name]["peak_memory_mb"]
+                radec[backend] = (ephemeris_ra, ephemeris_dec)
+                wall = sum(stage["wall_s"] for stage in stages.values())
+                results["runs"].append({
+                    "backend": backend,
+                    "samples": no_samples,
+                    "wall_s": wall,
+                    "samples_per_s": no_samples / wall,
+                    "stages": stages,
+                })
+                print("{:>11} {:>7} samples: {:8.3f} s ".format(backend, no_samples, wall) + " ".join("{}={:.3f}s".format(name, stage["wall_s"]) for name, stage in stages.items()))
+
+            for run in results["runs"][-len(backends):]:
+                ra_difference = wrapped_difference(radec[run["backend"]][0], radec["astropy"][0]) * 3600
+                dec_difference = (radec[run["backend"]][1] - radec["astropy"][1]) * 3600
+                run["max_ra_disagreement_arcsec"] = float(np.max(np.abs(ra_difference)))
+                run["max_dec_disagreement_arcsec"] = float(np.max(np.abs(dec_difference)))
+                if run["backend"] != "astropy":
+                    print("{:>11} {:>7} samples: max disagreement with astropy RA {:.6f}\" DEC {:.6f}\"".format(run["backend"], no_samples, run["max_ra_disagreement_arcsec"], run["max_dec_disagreement_arcsec"]))
+        sp3_cache._load_track.cache_clear()
+        observer_geometry.load_table.cache_clear()
+    sp3_cache.cache_folder, observer_geometry.cache_folder = cache_folder, observer_cache_folder
+
+    results["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if output_file is None:
+        output_file = output_folder + "benchmark_" + datetime.now().strftime("%Y%m%dT%H%M%S") + ".json"
+    if os.path.dirname(output_file):
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    with open(output_file, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+    print("Done :D Benchmark saved in " + output_file)
+    return results
+
+# RA difference wrapped to [-180, 180) degrees
+def wrapped_difference(ra_a, ra_b):
+    return (ra_a - ra_b + 180) % 360 - 180
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the astropy, skyfield and precomputed comparison backends on synthetic telescope tracks.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=sample_sizes, help="numbers of samples (default: %(default)s)")
+    parser.add_argument("--output", default=None, help="JSON file to save the results to (default: " + output_folder + "benchmark_<time>.json)")
+    args = parser.parse_args()
+    benchmark(args.sizes, args.output)
@@ -1,67 +1,218 @@
-from photutils.detection import find_peaks, DAOStarFinder
-from photutils.background import Background2D, MedianBackground
-from photutils.aperture import aperture_photometry, CircularAperture
-from photutils.psf import extract_stars, EPSFBuilder
-from astropy.table import Table
-from astropy.stats import mad_std, SigmaClip, sigma_clipped_stats
-from astropy.io import fits
-from astropy.nddata import NDData
-from astropy.visualization import simple_norm
+import argparse
+import hashlib
+import os
+import time
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import matplotlib.pyplot as plt
-
-image = fits.open('astrometry_testing/00051718_QZS-4__MICHIBIKI-4__#42965U_20220502_1.000secs_2x2_Light.fit')
-
-data = image[0].data
-
-# Estimate background
-sigma_clip = SigmaClip(sigma=3.)
-bkg_estimator = MedianBackground()
-bkg = Background2D(data, (50, 50), filter_size=(3, 3), sigma_clip=sigma_clip, bkg_estimator=bkg_estimator)
-
-# Remove background
-data_nobkg = data - bkg.background
-
-# Find stars
-mean, median, std = sigma_clipped_stats(data, sigma=3.0)
-daofind = DAOStarFinder(fwhm=5.0, threshold=5.*std)
-sources = daofind(data_nobkg)
-
-size = 25
-hsize = (size-1)/2
-x = sources['xcentroid']
-y = sources['ycentroid']
-mask = ((x > hsize) & (x < (data_nobkg.shape[1] -1 - hsize)) &
-(y > hsize) & (y < (data_nobkg.shape[0] -1 - hsize)))
-stars_tbl = Table()
-stars_tbl['x'] = x[mask]
-stars_tbl['y'] = y[mask]
-
-norm = simple_norm(data_nobkg, 'log', percent = 99.)
-plt.imshow(data_nobkg, cmap='viridis', norm=norm)
-plt.plot(x, y, 'o', 'bo', markerfacecolor='none')
-plt.show()
-#plt.imshow(data_nobkg, origin='lower', cmap='viridis')
-#plt.plot(stars_tbl['x'], stars_tbl['y'], 'bo', markerfacecolor='none')
-#plt.show()
-
-nddata = NDData(data = data_nobkg)
-stars = extract_stars(nddata, stars_tbl, size = 35)
-print(stars.all_stars)
-
-nrows = 5
-ncols = 4
-fig, ax = plt.subplots(nrows = len(stars), ncols = 1, figsize = (20, 20), squeeze=True)
-ax = ax.ravel()
-for i in range(len(stars)):
-    norm = simple_norm(stars[i], 'log', percent = 99.)
-    ax[i].imshow(stars[i], norm=norm, origin='lower', cmap='viridis')
-
-epsf_builder = EPSFBuilder(oversampling=4, maxiters=3, progress_bar=True)
-epsf, fitted_stars = epsf_builder(stars)
-
-print(fitted_stars.center_flat)
-norm = simple_norm(epsf.data, 'log', percent = 99.)
-plt.imshow(epsf.data, norm=norm, origin='lower', cmap='viridis')
-plt.colorbar()
-plt.show()
\ No newline at end of file
+from alive_progress import alive_bar
+import fileutils
+import satellite_centroid
+import roo_vs_ephemeris
+import timeutils
+# astropy, photutils and matplotlib are imported inside the functions that use them
+
+# CONFIG
+# PSF-fit centroids for every FITS frame in <frame_folder>
+# The frames are grouped into sessions (night + camera setting). Each session's ePSF is built once, from stars in a
+# sample of its frames, and cached in <epsf_folder>, so later runs (and every other frame of the session) reuse it.
+# Every star found by DAOStarFinder is then fitted with the ePSF for a sub-pixel centroid, one fit per star.
+# One table per frame is written to <output_folder> (<frame>_psf_centroids.ecsv)
+
+frame_folder = "astrometry_testing/" # Choose the folder of FITS frames
+epsf_folder = "epsf_cache/" # Choose where to keep the ePSF models
+output_folder = "psf_centroids/" # Choose where to save the centroid tables
+workers = 1 # Number of processes to spread the frames over
+
+sample_frames = 10 # Frames per session used to build its ePSF
+size = 25 # Stars closer than size/2 to the edge are left out of the ePSF
+star_size = 35 # Star cutouts used to build the ePSF (pixels)
+oversampling = 4
+maxiters = 3
+fit_shape = (11, 11) # Pixels fitted around each star
+fwhm = 5.0 # DAOStarFinder FWHM (pixels)
+threshold = 5.0 # Detection threshold in standard deviations of the (sigma clipped) frame
+
+# Header keywords that make up a camera setting
+setting_keywords = ["INSTRUME", "XBINNING", "YBINNING", "EXPTIME", "GAIN", "FILTER", "NAXIS1", "NAXIS2"]
+
+####################################################################
+
+# Observing night of a frame at the ROO (see timeutils.observing_night)
+def frame_night(header):
+    return str(timeutils.observing_night(np.datetime64(header["DATE-OBS"], 'ns'), roo_vs_ephemeris.roo[1]))
+
+# Session a frame belongs to, e.g. 2022-05-01_3f2a9c1b
+def session_key(header):
+    setting = "|".join(str(header.get(keyword)) for keyword in setting_keywords)
+    return frame_night(header) + "_" + hashlib.sha256(setting.encode()).hexdigest()[:8]
+
+def sessions(frames):
+    from astropy.io import fits
+    grouped = {}
+    for frame in frames:
+        grouped.setdefault(session_key(fits.getheader(frame)), []).append(frame)
+    return grouped
+
+# DAOStarFinder detections in a background-subtracted frame (the frame's own sigma clipped std sets the threshold)
+def find_stars(data, data_nobkg):
+    from astropy.stats import sigma_clipped_stats
+    mean, median, std = sigma_clipped_stats(data, sigma=3.0)
+    sources = satellite_centroid.find_sources(data_nobkg, fwhm=fwhm, threshold=threshold, std=std)
+    return np.asarray(sources["xcentroid"]), np.asarray(sources["ycentroid"])
+
+# Stars far enough from the edge for a full cutout
+def stars_table(x, y, shape):
+    from astropy.table import Table
+    hsize = (size-1)/2
+    mask = ((x > hsize) & (x < (shape[1] -1 - hsize)) &
+    (y > hsize) & (y < (shape[0] -1 - hsize)))
+    stars_tbl = Table()
+    stars_tbl['x'] = x[mask]
+    stars_tbl['y'] = y[mask]
+    return stars_tbl
+
+# ePSF from the stars in an even sample of a session's frames
+def build_epsf(frames):
+    from astropy.nddata import NDData
+    from photutils.psf import extract_stars, EPSFBuilder
+    sample = [frames[i] for i in np.unique(np.linspace(0, len(frames) - 1, min(sample_frames, len(frames))).astype(int))]
+    nddatas, tables = [], []
+    for frame in sample:
+        header, data = satellite_centroid.read_frame(frame)
+        data_nobkg = satellite_centroid.remove_background(data)
+        stars_tbl = stars_table(*find_stars(data, data_nobkg), data_nobkg.shape)
+        if len(stars_tbl) > 0:
+            nddatas.append(NDData(data=data_nobkg))
+            tables.append(stars_tbl)
+    if not tables:
+        raise ValueError("No stars to build an ePSF from")
+    stars = extract_stars(nddatas, tables, size=star_size)
+    epsf_builder = EPSFBuilder(oversampling=oversampling, maxiters=maxiters, progress_bar=False)
+    epsf, fitted_stars = epsf_builder(stars)
+    return epsf.data, len(stars)
+
+# The build parameters are hashed into the file name (as grid_step is for the observer tables), so changing any of
+# them builds a new ePSF rather than reusing one made with the old settings
+def epsf_file(key, epsf_folder=epsf_folder):
+    parameters = "|".join(str(parameter) for parameter in [sample_frames, size, star_size, oversampling, maxiters, fwhm, threshold])
+    return os.path.join(epsf_folder, "epsf_" + key + "_" + hashlib.sha256(parameters.encode()).hexdigest()[:8] + ".fits")
+
+# The session's ePSF from the cache, built (and cached) if it isn't there yet
+def session_epsf(key, frames, epsf_folder=epsf_folder):
+    from astropy.io import fits
+    path = epsf_file(key, epsf_folder)
+    if os.path.isfile(path):
+        return path
+    print("Building the ePSF for session " + key + " from " + str(min(sample_frames, len(frames))) + " frames...")
+    data, stars = build_epsf(frames)
+    header = fits.Header()
+    header["OVERSAMP"] = oversampling
+    header["NSTARS"] = stars
+    header["SESSION"] = key
+    # Written atomically, so workers and concurrent runs never load a partial model
+    fileutils.atomic_write(path, lambda tmp_path: fits.PrimaryHDU(data, header=header).writeto(tmp_path, overwrite=True), ".fits")
+    return path
+
+# ePSF model from the cache, loaded once per process
+@lru_cache(maxsize=8)
+def load_epsf(path):
+    from astropy.io import fits
+    with fits.open(path) as image:
+        data, header = image[0].data.astype(float), image[0].header
+    try:
+        from photutils.psf import ImagePSF
+        return ImagePSF(data, oversampling=header["OVERSAMP"])
+    except ImportError:
+        from photutils.psf import EPSFModel # photutils < 1.13
+        return EPSFModel(data, oversampling=header["OVERSAMP"])
+
+# ePSF fit of every star in a frame, starting from the DAOStarFinder positions
+def fit_centroids(path, epsf_path):
+    from astropy.table import Table
+    from photutils.psf import PSFPhotometry
+    header, data = satellite_centroid.read_frame(path)
+    data_nobkg = satellite_centroid.remove_background(data)
+    x, y = find_stars(data, data_nobkg)
+    centroids = Table(names=["id", "xcentroid", "ycentroid", "flux", "qfit"], dtype=[int, float, float, float, float])
+    if len(x) > 0:
+        init_params = Table()
+        init_params["x_init"] = x
+        init_params["y_init"] = y
+        psf_photometry = PSFPhotometry(load_epsf(epsf_path), fit_shape, aperture_radius=fwhm)
+        fitted = psf_photometry(data_nobkg, init_params=init_params)
+        centroids = Table([np.arange(1, len(fitted) + 1), np.asarray(fitted["x_fit"]), np.asarray(fitted["y_fit"]), np.asarray(fitted["flux_fit"]), np.asarray(fitted["qfit"])],
+                          names=centroids.colnames)
+    centroids.meta["frame"] = os.path.basename(path)
+    centroids.meta["date_obs"] = header.get("DATE-OBS")
+    centroids.meta["epsf"] = os.path.basename(epsf_path)
+    return centroids
+
+def process_frame(path, epsf_path, output_folder):
+    try:
+        centroids = fit_centroids(path, epsf_path)
+    except (OSError, ValueError, KeyError) as error:
+        print("Couldn't fit " + os.path.basename(path) + ": " + str(error))
+        return None
+    centroids.write(os.path.join(output_folder, os.path.splitext(os.path.basename(path))[0] + "_psf_centroids.ecsv"), format="ascii.ecsv", overwrite=True)
+    return len(centroids)
+
+def batch(frame_folder, output_folder, epsf_folder=epsf_folder, workers=1):
+    frames = satellite_centroid.frame_files(frame_folder)
+    os.makedirs(output_folder, exist_ok=True)
+    start = time.perf_counter()
+    jobs = []
+    for key, session_frames in sessions(frames).items():
+        try:
+            epsf_path = session_epsf(key, session_frames, epsf_folder)
+        except ValueError as error:
+            print(str(error) + " for session " + key + ", skipping its " + str(len(session_frames)) + " frames")
+            continue
+        jobs += [(frame, epsf_path) for frame in session_frames]
+
+    print("Fitting " + str(len(jobs)) + " frames...")
+    counts = []
+    with alive_bar(len(jobs)) as bar:
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for count in pool.map(process_frame, [job[0] for job in jobs], [job[1] for job in jobs], [output_folder] * len(jobs), chunksize=4):
+                    counts.append(count)
+                    bar()
+        else:
+            for frame, epsf_path in jobs:
+                counts.append(process_frame(frame, epsf_path, output_folder))
+                bar()
+    elapsed = time.perf_counter() - start
+    done = [count for count in counts if count is not None]
+    print("Done :D " + str(len(done)) + " frames (" + str(sum(done)) + " stars) in " + format(elapsed, ".1f") + "s, "
+          + format(len(done) / elapsed if elapsed > 0 else 0, ".2f") + " frames/s. Centroids saved in " + output_folder)
+    return counts
+
+# Plot a cached ePSF
+def plot_epsf(path):
+    import matplotlib.pyplot as plt
+    from astropy.io import fits
+    from astropy.visualization import simple_norm
+    data = fits.getdata(path)
+    norm = simple_norm(data, 'log', percent = 99.)
+    plt.imshow(data, norm=norm, origin='lower', cmap='viridis')
+    plt.colorbar()
+    plt.show()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="roo-psf-centroid", description="ePSF-fit centroids for a folder of FITS frames, one cached ePSF per night and camera setting.")
+    parser.add_argument("frame_folder", nargs="?", default=frame_folder, help="folder of FITS frames (default: %(default)s)")
+    parser.add_argument("--output-dir", default=output_folder, help="where to save the centroid tables (default: %(default)s)")
+    parser.add_argument("--epsf-cache", default=epsf_folder, help="where to keep the ePSF models (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=workers, help="number of worker processes (default: %(default)s)")
+    parser.add_argument("--plot", metavar="EPSF", help="plot a cached ePSF instead")
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.plot:
+        plot_epsf(args.plot)
+    else:
+        batch(args.frame_folder, args.output_dir, args.epsf_cache, args.workers)
+
+if __name__ == "__main__":
+    main()
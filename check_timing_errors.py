@@ -1,15 +1,22 @@
 import roo_vs_ephemeris
+import timing_solver
 import numpy as np
-from datetime import datetime, timedelta
 
 ephemeris_folder = "qzr_ephemeris/" # Choose location of QZSS ephemeris files
 telescope_data_folder = "telescope_data/" # Choose where to put the telescope obs csvs
 processed_telescope_data = "processed_telescope_data/"
+sweep_results = "time_offset_analysis/timing_sweep/" # Results store with every offset
+offsets_file = "time_offset_analysis/timing_offsets.csv" # Fitted offset for every observation file
 
-time_offsets = np.arange(0, 100, 100)
+mode = "solve" # Choose between sweep (brute-force grid of offsets) or solve (least-squares fit from the ephemeris rates)
+solve_drift = False # Also fit a linear clock drift when solving
 
-for offset in time_offsets:
-    offset_datetime = timedelta(milliseconds=int(offset))
-    print("Trying offset " + str(offset) + "ms")
-    output_dir = "time_offset_analysis/"
-    roo_vs_ephemeris.main(ephemeris_folder, telescope_data_folder, output_dir, offset_datetime)
\ No newline at end of file
+time_offsets = np.arange(-1000, 1000, 100)
+
+if mode == "sweep":
+    print("Trying offsets " + str(time_offsets[0]) + " to " + str(time_offsets[-1]) + "ms")
+    roo_vs_ephemeris.sweep(ephemeris_folder, telescope_data_folder, sweep_results, time_offsets)
+elif mode == "solve":
+    timing_solver.solve_offsets(ephemeris_folder, telescope_data_folder, offsets_file, drift=solve_drift)
+else:
+    print("Please choose a valid mode!")
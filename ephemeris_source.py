@@ -0,0 +1,46 @@
+import numpy as np
+from functools import lru_cache
+import sp3_cache
+import timeutils
+
+# Multi-day ephemeris source
+# SP3 files cover one GPS day each (qzf<week><day>.sp3). An observation near midnight, or one running past it,
+# needs the neighbouring day too, both for its own timestamps and for the Lagrange window at the edge of the day.
+# days_needed() works out the GPS days covering a time range plus a margin, and merged_track() joins the tracks
+# of those files into one continuous, de-duplicated track (cached per set of files).
+
+margin = np.timedelta64(2, 'h') # Extra ephemeris either side of a time range (covers a 9 point window at 15 min spacing)
+
+gps_epoch = sp3_cache.gps_epoch
+day = np.timedelta64(1, 'D')
+
+# GPS week and day of week of GPS times
+def gps_week_day(time_gps):
+    days = (np.asarray(time_gps, dtype='datetime64[ns]') - gps_epoch) // day
+    return days // 7, days % 7
+
+def sp3_file_name(ephemeris_type, week, weekday):
+    prefix = {"final": "qzf", "rapid": "qzr"}[ephemeris_type]
+    return prefix + str(int(week)) + str(int(weekday)) + ".sp3"
+
+# (week, day) of every GPS day touched by [start, end] (UTC) widened by the margin
+def days_needed(start_utc, end_utc, margin=margin):
+    start_gps = timeutils.utc_to_gps(start_utc) - margin
+    end_gps = timeutils.utc_to_gps(end_utc) + margin
+    first, last = (start_gps - gps_epoch) // day, (end_gps - gps_epoch) // day
+    return [(int(days // 7), int(days % 7)) for days in range(int(first), int(last) + 1)]
+
+# One track (GPS epochs as datetime64[ns], ITRS positions in km) from several SP3 files
+# Epochs found in more than one file (adjacent days both holding midnight) are kept once, from the earlier file
+@lru_cache(maxsize=32)
+def merged_track(paths_to_sp3, satellite):
+    times, positions = [], []
+    for path_to_sp3 in paths_to_sp3:
+        satellite_time_gps, satellite_itrs = sp3_cache.load_ephemeris(path_to_sp3, satellite)
+        times.append(satellite_time_gps)
+        positions.append(satellite_itrs)
+    times = np.concatenate(times)
+    positions = np.concatenate(positions)
+    order = np.argsort(times, kind='stable')
+    times, first = np.unique(times[order], return_index=True)
+    return times, positions[order][first]
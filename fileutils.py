@@ -0,0 +1,32 @@
+import hashlib
+import os
+import tempfile
+
+# File helpers shared by the pipeline modules (kept free of any heavy or network imports)
+
+# sha256 of a file's contents, read in 1 MB blocks
+def sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# Writes path through a temporary file next to it: write(tmp_path) fills it in, and it's only renamed into place once
+# that has finished (and unless write returns False, e.g. when a download doesn't validate), so an interrupted run or
+# another process never sees a partial file. Returns whether path was written.
+def atomic_write(path, write, suffix=""):
+    folder = os.path.dirname(os.path.abspath(path))
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".tmp_", suffix=suffix)
+    os.close(fd)
+    try:
+        written = write(tmp_path) is not False
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    if written:
+        os.replace(tmp_path, path)
+    else:
+        os.unlink(tmp_path)
+    return written
@@ -2,12 +2,19 @@ import plotly.express as px
 import numpy as np
 import pandas as pd
 import os
-import re
+import time
+import html
 import kaleido
-from datetime import datetime
+import results_store
+import plate_solves
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
 #sus obs
 #220303 qzs1
 
+# Comparison results are read from results stores (see results_store.py), old comparison csvs can be
+# brought in with results_store.import_comparison_csv()
+
 #Overall stats
 comparison_data = "initial_accuracy_determination/"
 satellite = "QZS1"
@@ -18,6 +25,7 @@ angle = "RA"
 
 #Timing stats
 timing_data = "time_offset_analysis/"
+timing_sweep = "timing_sweep/" # Results store written by check_timing_errors.py
 satellite_t = "QZS1"
 
 date = "220302"
@@ -26,44 +34,65 @@ date = "220302"
 camera_data = "camera_settings/"
 
 #Astrometry RMS
-rms_data = "rms_data/"
+rms_data = "rms_data/" # Hand-collected rms csvs, used if there's no plate-solve index
+plate_solve_index = plate_solves.index_file # Built by plate_solves.py from the astrometry.net outputs
+
+#Batch report
+report_folder = "timing_graphs/" # Choose where to render the figures (and index.html) to
+report_workers = 4 # Number of kaleido renderer processes
+
+# Aggregation
+# Each results store (and the rms folder) is read once into a single DataFrame, and the per-file/per-satellite
+# stats are grouped operations on it. The plots below all take their data from these (cached, so don't modify them).
+
+@lru_cache(maxsize=None)
+def load_comparisons(root, offset_ms=0):
+    comparison = results_store.read_results(root, columns=["file", "satellite", "date", "timestamp", "ra_diff", "dec_diff"], offset_ms=offset_ms)
+    # Time elapsed since the start of each observation file
+    comparison["time_elapsed"] = (comparison["timestamp"] - comparison.groupby("file")["timestamp"].transform("min")).dt.total_seconds()
+    return comparison
+
+# Mean/std (ddof=0) of the RA/DEC differences per group, and the norm of the mean
+def aggregate(comparison, by):
+    differences = comparison.groupby(by)[["ra_diff", "dec_diff"]]
+    means = differences.mean()
+    stds = differences.std(ddof=0)
+    stats = pd.DataFrame({"ra_mean": means["ra_diff"], "dec_mean": means["dec_diff"], "ra_std": stds["ra_diff"], "dec_std": stds["dec_diff"], "samples": differences.size()})
+    stats["norm"] = np.hypot(stats["ra_mean"], stats["dec_mean"])
+    return stats.reset_index()
+
+@lru_cache(maxsize=None)
+def file_stats(root, offset_ms=0):
+    return aggregate(load_comparisons(root, offset_ms), ["file", "satellite", "date"])
+
+@lru_cache(maxsize=None)
+def satellite_stats(root, offset_ms=0):
+    return aggregate(load_comparisons(root, offset_ms), ["satellite"])
+
+@lru_cache(maxsize=None)
+def timing_stats(root):
+    sweep = results_store.read_results(root, columns=["satellite", "date", "offset_ms", "ra_diff", "dec_diff"])
+    return aggregate(sweep, ["satellite", "date", "offset_ms"])
+
+# Every astrometry rms csv in one DataFrame (column 5 onwards of each file)
+@lru_cache(maxsize=None)
+def load_rms(root):
+    rms = [pd.read_csv(root + file, usecols=range(5, 11)).set_axis(["RA_DIFF", "DEC_DIFF", "NORM_RA_DEC", "RMS", "RMS_X", "RMS_Y"], axis=1).assign(FILE=file)
+           for file in sorted(os.listdir(root))]
+    return pd.concat(rms, ignore_index=True)
+
+# The plate-solve index joined to the comparison results, in the same columns as load_rms (one FILE per satellite and date)
+@lru_cache(maxsize=None)
+def load_plate_solves(index_path, root):
+    joined = plate_solves.join_results(plate_solves.read_index(index_path), root)
+    return pd.DataFrame({"RA_DIFF": joined["ra_diff"], "DEC_DIFF": joined["dec_diff"], "NORM_RA_DEC": np.hypot(joined["ra_diff"], joined["dec_diff"]),
+                         "RMS": joined["rms"], "RMS_X": joined["rms_x"], "RMS_Y": joined["rms_y"], "FILE": joined["satellite"] + "_" + joined["date"]})
 
 def residuals(satellite, angle):
-    ra_residuals = np.array([])
-    dec_residuals = []
-    times = []
-    date_list = []
-
-    for file in os.listdir(comparison_data):
-        file_path = comparison_data + file
-        comparison_file = np.genfromtxt(file_path, delimiter = ",", dtype = None, encoding='utf-8')
-        satellite_file = file[21:25]
-        
-
-        if satellite == satellite_file.upper():
-            ra_diff = comparison_file[1:, 5].astype(float)
-            dec_diff = comparison_file[1:,6].astype(float)
-            time = comparison_file[1:,0]
-
-            time_float = []
-            date = file[14:20]
-            ra_residuals = np.concatenate((ra_residuals, ra_diff))
-            dec_residuals = np.concatenate((dec_residuals, dec_diff))
-
-
-            for i in np.arange(len(time)):
-                time_float.append(datetime.fromisoformat(time[i]).timestamp())
-                print(time_float[i])
-                time_elapsed = time_float[i] - time_float[0]
-                times.append(time_elapsed)
-                date_list.append(date)
-
-
-    residuals = np.transpose(np.array([ra_residuals, dec_residuals, times, date_list]))
-    df_res = pd.DataFrame(residuals, columns = ["RA_DIFF", "DEC_DIFF", "TIME", "DATES"])
-    df_res["TIME"] = pd.to_numeric(df_res["TIME"])
-    df_res["RA_DIFF"] = pd.to_numeric(df_res["RA_DIFF"])
-    df_res["DEC_DIFF"] = pd.to_numeric(df_res["DEC_DIFF"])
+    comparison = load_comparisons(comparison_data)
+    comparison = comparison[comparison["satellite"] == satellite]
+
+    df_res = pd.DataFrame({"RA_DIFF": comparison["ra_diff"], "DEC_DIFF": comparison["dec_diff"], "TIME": comparison["time_elapsed"], "DATES": comparison["date"]})
     df_res = df_res.sort_values(by="TIME")
 
 
@@ -100,45 +129,22 @@ def residuals(satellite, angle):
 #residuals("QZS4", "RA")
 
 def overall_stats(satellite, plot_type):
-    qzsx_ra = []
-    qzsx_dec = []
-    qzsx_norm = []
-    qzsx_dates = []
-    all_ra_diff = []
-    all_dec_diff = []
-    all_qzsx_ra_diff = []
-    all_qzsx_dec_diff = []
-    all_ra_diff_mean = []
-    all_dec_diff_mean = []
-    all_norm_diff_mean = []
-    all_names = []
-
-    for file in os.listdir(comparison_data):
-        file_path = comparison_data + file
-        comparison_file = np.genfromtxt(file_path, delimiter = ",", dtype = None, encoding='utf-8')
-
-        ra_diff = comparison_file[1:, 5].astype(float)
-        ra_diff_mean = np.mean(ra_diff)
-        all_ra_diff = np.concatenate((all_ra_diff, ra_diff))
-
-        dec_diff = comparison_file[1:,6].astype(float)
-        dec_diff_mean = np.mean(dec_diff)
-        all_dec_diff = np.concatenate((all_dec_diff, dec_diff))
-
-        norm_ra_dec = np.linalg.norm([ra_diff_mean, dec_diff_mean])
-
-        all_ra_diff_mean.append(ra_diff_mean)
-        all_dec_diff_mean.append(dec_diff_mean)
-        all_norm_diff_mean.append(norm_ra_dec)
-        all_names.append(file[21:25])
-
-        if satellite.lower() in file:
-            qzsx_ra.append(ra_diff_mean)
-            qzsx_dec.append(dec_diff_mean)
-            qzsx_norm.append(norm_ra_dec)
-            qzsx_dates.append(file[14:20])
-            all_qzsx_ra_diff = np.concatenate((all_qzsx_ra_diff, ra_diff))
-            all_qzsx_dec_diff = np.concatenate((all_qzsx_dec_diff, dec_diff))
+    comparison = load_comparisons(comparison_data)
+    means = file_stats(comparison_data)
+    print(satellite_stats(comparison_data).to_string(index=False))
+
+    all_ra_diff_mean = means["ra_mean"].to_numpy()
+    all_dec_diff_mean = means["dec_mean"].to_numpy()
+    all_norm_diff_mean = means["norm"].to_numpy()
+    all_names = means["satellite"].to_numpy(dtype=str)
+
+    qzsx = means[means["satellite"] == satellite.upper()]
+    qzsx_ra = qzsx["ra_mean"].to_numpy()
+    qzsx_dec = qzsx["dec_mean"].to_numpy()
+    qzsx_norm = qzsx["norm"].to_numpy()
+    qzsx_dates = qzsx["date"].to_numpy()
+    all_qzsx_ra_diff = comparison.loc[comparison["satellite"] == satellite.upper(), "ra_diff"].to_numpy()
+    all_qzsx_dec_diff = comparison.loc[comparison["satellite"] == satellite.upper(), "dec_diff"].to_numpy()
 
 
     if plot_type == "scatter":
@@ -228,31 +234,14 @@ def overall_stats(satellite, plot_type):
 
 #overall_stats(satellite, plot_type)
 
-def timing_analysis(satellite, date):
-
-    ra_error = []
-    dec_error = []
-    norm_error = []
-    offsets = []
-
-    for file in os.listdir(timing_data):
-        if satellite.lower() in file and date in file:
-            file_path = timing_data + file 
-            timing_file = np.genfromtxt(file_path, delimiter = ",", dtype = None, encoding='utf-8')
+def timing_figure(satellite, date):
+    stats = timing_stats(timing_data + timing_sweep)
+    means = stats[(stats["satellite"] == satellite.upper()) & (stats["date"] == date)]
 
-            ra_diff = timing_file[1:, 5].astype(float)
-            ra_diff_mean = np.mean(ra_diff)
-
-            dec_diff = timing_file[1:,6].astype(float)
-            dec_diff_mean = np.mean(dec_diff)
-
-            norm = np.linalg.norm([ra_diff_mean, dec_diff_mean])
-            offset = re.findall('[-+]?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?', file[0:5])
-
-            ra_error.append(ra_diff_mean)
-            dec_error.append(dec_diff_mean)
-            norm_error.append(norm)
-            offsets.append(offset[0])
+    offsets = means["offset_ms"].to_numpy()
+    ra_error = means["ra_mean"].to_numpy()
+    dec_error = means["dec_mean"].to_numpy()
+    norm_error = means["norm"].to_numpy()
 
     timing_array = np.transpose(np.array([offsets, ra_error, dec_error, norm_error]))
     df = pd.DataFrame(timing_array, columns = ["OFFSETS", "RA_ERROR", "DEC_ERROR", "NORM_ERROR"])
@@ -283,26 +272,60 @@ def timing_analysis(satellite, date):
         name = newnames[t.name],
         legendgroup = newnames[t.name],
         hovertemplate = t.hovertemplate.replace(t.name, newnames[t.name])))
+    return fig
 
-    fig.write_image("timing_graphs/" + date + "_" + satellite + ".png")
+def timing_analysis(satellite, date):
+    timing_figure(satellite, date).write_image("timing_graphs/" + date + "_" + satellite + ".png")
+
+# Batch report
+# Every (satellite, date) timing figure is built once (pairs deduplicated first) and rendered headlessly on a pool of
+# processes, each keeping one kaleido renderer running for all its figures instead of starting one per figure.
+# The images, an index.html showing them all and the render time of each figure go to <output_folder>.
+
+# Starts the worker's kaleido renderer once (kaleido 1.x; 0.2.x keeps its renderer alive after the first figure anyway)
+def init_renderer():
+    if hasattr(kaleido, "start_sync_server"):
+        kaleido.start_sync_server(silence_warnings=True)
+
+def render_figure(figure_json, path):
+    import plotly.io as pio
+    start = time.perf_counter()
+    pio.write_image(pio.from_json(figure_json), path)
+    return time.perf_counter() - start
+
+def write_index(output_folder, rendered):
+    rows = "".join("<h2>" + html.escape(name) + "</h2>\n<p>Rendered in " + format(seconds, ".2f") + "s</p>\n<img src=\"" + html.escape(image) + "\" width=\"1000\">\n"
+                   for name, image, seconds in rendered)
+    with open(os.path.join(output_folder, "index.html"), "w") as index:
+        index.write("<!DOCTYPE html>\n<html>\n<head><meta charset=\"utf-8\"><title>Timing analysis</title></head>\n<body>\n<h1>Timing analysis</h1>\n" + rows + "</body>\n</html>\n")
+
+def report(output_folder=report_folder, workers=report_workers):
+    os.makedirs(output_folder, exist_ok=True)
+    pairs = file_stats(comparison_data)[["satellite", "date"]].drop_duplicates().sort_values(["satellite", "date"])
+    start = time.perf_counter()
+    figures = []
+    for satellite, date in pairs.itertuples(index=False):
+        figures.append((satellite + " (" + date + ")", date + "_" + satellite + ".png", timing_figure(satellite, date).to_json()))
+    print("Built " + str(len(figures)) + " figures in " + format(time.perf_counter() - start, ".1f") + "s, rendering...")
+
+    seconds = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_renderer) as pool:
+        futures = {pool.submit(render_figure, figure_json, os.path.join(output_folder, image)): name for name, image, figure_json in figures}
+        for future in as_completed(futures):
+            seconds[futures[future]] = future.result()
+            print(futures[future] + " rendered in " + format(seconds[futures[future]], ".2f") + "s")
+    write_index(output_folder, [(name, image, seconds[name]) for name, image, _ in figures])
+    print("Done :D " + str(len(figures)) + " figures in " + format(time.perf_counter() - start, ".1f") + "s, see " + os.path.join(output_folder, "index.html"))
 
 def generate_timing():
-    for file in os.listdir(comparison_data):
-        date = file[14:20]
-        satellite = file[21:25]
-        print(satellite)
-        timing_analysis(satellite, date)
+    report(report_folder, report_workers)
 
 def camera_settings():
-    file = "compared_ctrl_220827_prn5_cleaned.csv"
-    file_path = camera_data + file
-    camera_file = np.genfromtxt(file_path, delimiter=",", dtype = None, encoding='utf-8')
-    ra_diff = camera_file[1:, 5].astype(float)
-    ra_diff_mean = np.mean(ra_diff)
-
-
-    dec_diff = camera_file[1:,6].astype(float)
-    dec_diff_mean = np.mean(dec_diff)
+    file = "ctrl_220827_prn5_cleaned.csv"
+    camera_file = load_comparisons(camera_data)
+    camera_file = camera_file[camera_file["file"] == file]
+    ra_diff = camera_file["ra_diff"].to_numpy()
+    ra_diff_mean = file_stats(camera_data).set_index("file").loc[file, "ra_mean"]
 
     fig = px.histogram(ra_diff, nbins=20, marginal="rug", title="PRN5 RA Error (Control) Mean: " + round(ra_diff_mean, 1).astype(str))
     fig.update_layout(
@@ -323,18 +346,8 @@ def camera_settings():
 #camera_settings()
             
 def astrometry_rms():
-    for file in os.listdir(rms_data):
-        file_path = rms_data + file
-        rms_file = np.genfromtxt(file_path, delimiter=",", dtype = None, encoding='utf-8')
-        ra_diff = rms_file[1:, 5].astype(float)
-        dec_diff = rms_file[1:, 6].astype(float)
-        norm_ra_dec = rms_file[1:, 7].astype(float)
-
-        rms = rms_file[1:, 8].astype(float)
-        rms_x = rms_file[1:, 9].astype(float)
-        rms_y = rms_file[1:, 10].astype(float)
-        rms = np.transpose(np.array([ra_diff, dec_diff, norm_ra_dec, rms_x, rms_y, rms]))
-        df_rms = pd.DataFrame(rms, columns = ["RA_DIFF", "DEC_DIFF", "NORM_RA_DEC", "RMS_X", "RMS_Y", "RMS"])
+    rms = load_plate_solves(plate_solve_index, comparison_data) if os.path.isfile(plate_solve_index) else load_rms(rms_data)
+    for file, df_rms in rms.groupby("FILE"):
         fig = px.scatter(df_rms, x="NORM_RA_DEC", y="RMS")
         fig.update_traces(marker={'size': 20, 'opacity': 0.8})
         fig.update_layout(
@@ -353,4 +366,5 @@ def astrometry_rms():
             )
         fig.show()
 
-astrometry_rms()
\ No newline at end of file
+if __name__ == "__main__":
+    astrometry_rms()
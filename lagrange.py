@@ -0,0 +1,71 @@
+import numpy as np
+
+# Lagrange interpolation over a whole satellite track at once
+# Build one LagrangeInterpolator per SP3 satellite track, then call it with every query time.
+# Each query's window is found with a single searchsorted, the basis weights are computed once
+# per query and applied to x/y/z together, so the cost per sample stays flat for large queries.
+
+chunk_size = 65536 # Number of query times evaluated at once (bounds the size of the temporary arrays)
+
+class LagrangeInterpolator:
+    def __init__(self, epochs, positions, order=9):
+        self.epochs = np.asarray(epochs)
+        self.t0 = self.epochs[0]
+        self.t = self.to_seconds(self.epochs)
+        self.positions = np.asarray(positions, dtype=float).reshape(len(self.t), -1)
+        self.order = min(order, len(self.t))
+        if np.any(np.diff(self.t) <= 0):
+            raise ValueError("Ephemeris epochs must be strictly increasing")
+
+    # Seconds since the first epoch, for datetime64 or plain numeric times
+    def to_seconds(self, times):
+        times = np.asarray(times)
+        if np.issubdtype(self.epochs.dtype, np.datetime64):
+            return (times.astype('datetime64[ns]') - self.t0.astype('datetime64[ns]')) / np.timedelta64(1, 's')
+        return (times - self.t0).astype(float)
+
+    # Index of the first node of each query's window, centred on the query and clamped to the track
+    def window_start(self, t):
+        start = np.searchsorted(self.t, t, side='right') - (self.order + 1) // 2
+        return np.clip(start, 0, len(self.t) - self.order)
+
+    # Basis weights (and their time derivatives) for each query, shape (N, order)
+    def weights(self, t, derivative=False):
+        start = self.window_start(t)
+        nodes = self.t[start[:, None] + np.arange(self.order)]
+        off_diagonal = ~np.eye(self.order, dtype=bool)
+        # ratio[n, j, m] = (t - t_m)/(t_j - t_m) for m != j and 1 on the diagonal
+        node_diff = nodes[:, :, None] - nodes[:, None, :]
+        ratio = np.ones_like(node_diff)
+        np.divide(t[:, None, None] - nodes[:, None, :], node_diff, out=ratio, where=off_diagonal)
+        weights = ratio.prod(axis=2)
+        if not derivative:
+            return start, weights, None
+
+        # d/dt L_j = sum_{k != j} 1/(t_j - t_k) * prod_{m != j, k} ratio[j, m]
+        # The leave-one-out products come from prefix/suffix cumulative products so nodes never divide by zero
+        ones = np.ones(ratio.shape[:2] + (1,))
+        prefix = np.concatenate((ones, np.cumprod(ratio[:, :, :-1], axis=2)), axis=2)
+        suffix = np.concatenate((np.cumprod(ratio[:, :, :0:-1], axis=2)[:, :, ::-1], ones), axis=2)
+        inverse_diff = np.zeros_like(node_diff)
+        np.divide(1.0, node_diff, out=inverse_diff, where=off_diagonal)
+        weights_dot = (inverse_diff * prefix * suffix).sum(axis=2)
+        return start, weights, weights_dot
+
+    # Interpolated positions (N, 3) at the query times, plus velocities (per second) if velocity=True
+    def __call__(self, times, velocity=False):
+        t = np.atleast_1d(self.to_seconds(times))
+        positions = np.empty((len(t), self.positions.shape[1]))
+        velocities = np.empty_like(positions) if velocity else None
+        window = np.arange(self.order)
+        for i in range(0, len(t), chunk_size):
+            chunk = slice(i, i + chunk_size)
+            start, weights, weights_dot = self.weights(t[chunk], derivative=velocity)
+            nodes = self.positions[start[:, None] + window]
+            positions[chunk] = np.einsum('nj,njk->nk', weights, nodes)
+            if velocity:
+                velocities[chunk] = np.einsum('nj,njk->nk', weights_dot, nodes)
+
+        if velocity:
+            return positions, velocities
+        return positions
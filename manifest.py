@@ -0,0 +1,119 @@
+import json
+import os
+import hashlib
+from functools import lru_cache
+from pathlib import Path
+import fileutils
+
+# Processing manifest
+# <output_dir>/_manifest.json records what the results of every observation file / offset in the store were computed
+# from: the csv (sha256), the SP3 file of every GPS day it needed (sha256, or None if the day wasn't available),
+# the backend, the ephemeris type and the code version. A rerun only recomputes the entries where one of those changed
+# (or whose results are gone), so nightly runs over the whole archive only cost as much as the new data.
+# Hashes are stored with the file's size and mtime and only recomputed when those change.
+# (pyarrow skips files starting with _, so the manifest can live in the results store folder)
+
+manifest_name = "_manifest.json"
+save_every = 50 # Files recorded between saves of the manifest during a run (it's always saved at the end)
+
+# Modules whose code changes the results
+pipeline_modules = ["roo_vs_ephemeris", "roo_vs_ephemeris_skyfield", "lagrange", "sp3_reader", "sp3_cache", "ephemeris_source", "timeutils", "results_store", "observer_geometry"]
+backend_packages = {"astropy": "astropy", "skyfield": "skyfield", "precomputed": "astropy"}
+
+def load(root):
+    path = Path(root) / manifest_name
+    if not path.is_file():
+        return {}
+    with open(path) as manifest_file:
+        return json.load(manifest_file)
+
+# Written to a temporary file and renamed into place, so an interrupted run never leaves half a manifest
+def save(root, manifest):
+    def write(tmp_path):
+        with open(tmp_path, "w") as tmp_file:
+            json.dump(manifest, tmp_file, indent=1, sort_keys=True)
+    fileutils.atomic_write(Path(root) / manifest_name, write, ".json")
+
+# A run loads the manifest once, records into it in memory and saves it every save_every files (recorded: files recorded
+# so far) and at the end, so a killed run only loses its last few entries and a long run doesn't rewrite it per file
+def checkpoint(root, manifest, recorded):
+    if recorded % save_every == 0:
+        save(root, manifest)
+
+def key(file_name, offset_ms):
+    return file_name + "@" + str(int(offset_ms)) + "ms"
+
+# size, mtime and sha256 of a file; the sha256 of previous is reused if the size and mtime haven't changed
+def fingerprint(path, previous=None):
+    stat = os.stat(path)
+    if previous is not None and previous["size"] == stat.st_size and previous["mtime_ns"] == stat.st_mtime_ns:
+        return previous
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": fileutils.sha256(path)}
+
+# Source of the pipeline modules plus the backend library version
+@lru_cache(maxsize=None)
+def code_version(backend):
+    from importlib.metadata import version, PackageNotFoundError
+    digest = hashlib.sha256()
+    for module in pipeline_modules:
+        path = Path(__file__).parent / (module + ".py")
+        if path.is_file():
+            digest.update(path.read_bytes())
+    try:
+        digest.update((backend + " " + version(backend_packages.get(backend, backend))).encode())
+    except PackageNotFoundError:
+        digest.update(backend.encode())
+    return digest.hexdigest()[:16]
+
+def day_key(gps_week, gps_day):
+    return str(gps_week) + "/" + str(gps_day)
+
+def parse_day_key(day):
+    gps_week, gps_day = day.split("/")
+    return int(gps_week), int(gps_day)
+
+# SP3 file of each GPS (week, day) in days, from {(week, day): path or None}
+def ephemeris_record(available, days, previous=None):
+    previous = previous or {}
+    record = {}
+    for gps_week, gps_day in days:
+        path_to_sp3 = available.get((gps_week, gps_day))
+        if path_to_sp3 is None:
+            record[day_key(gps_week, gps_day)] = None
+        else:
+            old = previous.get(day_key(gps_week, gps_day))
+            record[day_key(gps_week, gps_day)] = dict(fingerprint(path_to_sp3, old if old is not None and old["file"] == Path(path_to_sp3).name else None), file=Path(path_to_sp3).name)
+    return record
+
+def entry(input_fingerprint, satellite, date, offset_ms, backend, ephemeris_type, ephemeris):
+    return {"input": input_fingerprint, "satellite": satellite, "date": date, "offset_ms": int(offset_ms),
+            "backend": backend, "ephemeris_type": ephemeris_type, "code": code_version(backend), "ephemeris": ephemeris}
+
+# Why an entry has to be recomputed, checking everything but the ephemeris files (None if it doesn't)
+def stale(previous, path, backend, ephemeris_type):
+    if previous is None:
+        return "new"
+    if fingerprint(path, previous["input"])["sha256"] != previous["input"]["sha256"]:
+        return "input changed"
+    if previous["backend"] != backend:
+        return "backend changed"
+    if previous["ephemeris_type"] != ephemeris_type:
+        return "ephemeris type changed"
+    if previous["code"] != code_version(backend):
+        return "code changed"
+    return None
+
+# GPS days an entry's results used
+def ephemeris_days(previous):
+    return [parse_day_key(day) for day in previous["ephemeris"]]
+
+# Whether the SP3 files the entry's results came from are still the ones that would be used now
+def ephemeris_changed(previous, available):
+    for day, old in previous["ephemeris"].items():
+        path_to_sp3 = available.get(parse_day_key(day))
+        if old is None or path_to_sp3 is None:
+            if old is not None or path_to_sp3 is not None:
+                return True
+        elif Path(path_to_sp3).name != old["file"] or fingerprint(path_to_sp3, old)["sha256"] != old["sha256"]:
+            return True
+    return False
@@ -0,0 +1,129 @@
+from functools import lru_cache
+from pathlib import Path
+import numpy as np
+import fileutils
+import timeutils
+# astropy is imported inside the functions that use it, and only to build the tables
+
+# Precomputed observer geometry for the ROO
+# The ITRS -> GCRS rotation is the only time-dependent part of the topocentric vector of a fixed site:
+#   r_gcrs = R(t) (r_satellite_itrs - r_roo_itrs),  R(t) = A(t) Rz(ERA(t))
+# The Earth rotation angle (ERA) is computed analytically (IERS 2003, as erfa.era00) from UT1, and A(t) - precession,
+# nutation, frame bias and polar motion - only drifts by a few 1e-6 rad over a night. So per observing night a table of
+# A(t) and TT - UT1 on a <grid_step> grid is built once with astropy (the same IERS data and models transform_batch uses)
+# and cached in <cache_folder>; any obstime is then linearly interpolated from it, and the vectors are rotated with
+# plain NumPy products.
+# Accuracy against astropy's ITRS -> GCRS with the 300 s grid: < 3e-5 arcsec (the interpolation error grows with
+# grid_step squared, ~1e-4 arcsec at 600 s). Tables are site-independent; delete <cache_folder> to pick up new IERS data.
+
+cache_folder = "observer_cache/" # Choose where to keep the rotation tables
+grid_step = 300 # Spacing of the table (TT seconds)
+grid_margin = 2 # Extra grid points either side of each night
+
+j2000_tt = np.datetime64("2000-01-01T12:00:00", "ns")
+
+# TT seconds since J2000 of UTC datetimes
+def tt_seconds(times):
+    return (timeutils.to_ns(timeutils.utc_to_tt(times)) - timeutils.to_ns(j2000_tt)) / 1e9
+
+# Earth rotation angle (radians) of UT1 Julian dates given as whole + fraction
+def earth_rotation_angle(jd, fraction):
+    t = (jd - 2451545.0) + fraction
+    turns = np.mod(jd, 1.0) + np.mod(fraction, 1.0) + 0.7790572732640 + 0.00273781191135448 * t
+    return 2 * np.pi * np.mod(turns, 1.0)
+
+def table_file(night_date):
+    return Path(cache_folder) / ("itrs_gcrs_" + str(night_date) + "_" + str(grid_step) + "s.npy")
+
+# (grid points, 11) table of [TT seconds since J2000, TT - UT1 (s), A (row-major 3x3)] covering a night
+def build_table(night_date):
+    from astropy import units as u
+    from astropy import coordinates as coord
+    from astropy.time import Time
+    import roo_vs_ephemeris
+    start = timeutils.utc_to_tt(timeutils.night_start(night_date, roo_vs_ephemeris.roo[1])) - np.timedelta64(grid_margin * grid_step, 's')
+    grid = start + np.arange(int(86400 / grid_step) + 1 + 2 * grid_margin) * np.timedelta64(grid_step, 's')
+    jd, fraction = timeutils.julian_date(grid)
+    obstime = Time(jd, fraction, format='jd', scale='tt')
+
+    # ITRS -> GCRS is a pure rotation, so the columns of R are the transformed unit vectors (scaled to avoid rounding)
+    scale = 1e4
+    columns = []
+    for axis in np.eye(3):
+        itrs = coord.ITRS(*(np.outer(axis * scale, np.ones(len(grid))) * u.km), obstime=obstime, representation_type='cartesian')
+        columns.append(itrs.transform_to(coord.GCRS(obstime=obstime)).cartesian.xyz.to_value(u.km) / scale)
+    rotation = np.stack(columns, axis=-1).transpose(1, 0, 2)
+
+    ut1 = obstime.ut1
+    tt_ut1 = ((obstime.jd1 - ut1.jd1) + (obstime.jd2 - ut1.jd2)) * 86400
+    table = rotation @ rotation_z(earth_rotation_angle(ut1.jd1, ut1.jd2)).transpose(0, 2, 1)
+    return np.column_stack(((timeutils.to_ns(grid) - timeutils.to_ns(j2000_tt)) / 1e9, tt_ut1, table.reshape(-1, 9)))
+
+def rotation_z(angle):
+    cos, sin = np.cos(angle), np.sin(angle)
+    zero, one = np.zeros_like(angle), np.ones_like(angle)
+    return np.stack([np.stack([cos, -sin, zero], -1), np.stack([sin, cos, zero], -1), np.stack([zero, zero, one], -1)], -2)
+
+# A night's table from the cache, built (and cached) if it isn't there yet; loaded once per process
+@lru_cache(maxsize=16)
+def load_table(night_date):
+    path = table_file(night_date)
+    if not path.is_file():
+        print("Building the ITRS -> GCRS table for the night of " + str(night_date) + "...")
+        # Written atomically, so workers building the same night never see a partial table
+        fileutils.atomic_write(path, lambda tmp_path: np.save(tmp_path, build_table(night_date)), ".npy")
+    return np.load(path)
+
+# ITRS vectors (3, n) rotated to GCRS at UTC datetimes, interpolated from the night tables
+def itrs_to_gcrs(vectors, times):
+    times = np.asarray(times, dtype='datetime64[ns]')
+    import roo_vs_ephemeris
+    vectors = np.asarray(vectors, dtype=float)
+    rotated = np.empty_like(vectors)
+    nights, index = np.unique(timeutils.observing_night(times, roo_vs_ephemeris.roo[1]), return_inverse=True)
+    for i, night_date in enumerate(nights):
+        selected = index == i if len(nights) > 1 else slice(None)
+        rotated[:, selected] = rotate(load_table(night_date), vectors[:, selected], times[selected])
+    return rotated
+
+def rotate(table, vectors, times):
+    tt = tt_seconds(times)
+    step = table[1, 0] - table[0, 0]
+    position = (tt - table[0, 0]) / step
+    i = np.clip(np.floor(position).astype(int), 0, len(table) - 2)
+    weight = (position - i)[:, None]
+    interpolated = table[i] * (1 - weight) + table[i + 1] * weight
+
+    # ERA from the exact (ns) TT Julian date minus the interpolated TT - UT1
+    jd, fraction = timeutils.julian_date(timeutils.utc_to_tt(times))
+    angle = earth_rotation_angle(jd, fraction - interpolated[:, 1] / 86400)
+    cos, sin = np.cos(angle), np.sin(angle)
+    x = cos * vectors[0] - sin * vectors[1]
+    y = sin * vectors[0] + cos * vectors[1]
+    z = vectors[2]
+    a = interpolated[:, 2:]
+    return np.array([a[:, 0] * x + a[:, 1] * y + a[:, 2] * z,
+                     a[:, 3] * x + a[:, 4] * y + a[:, 5] * z,
+                     a[:, 6] * x + a[:, 7] * y + a[:, 8] * z])
+
+# ITRS position (km) of an astropy EarthLocation, the ROO if None
+def observer_itrs(obs_location=None):
+    from astropy import units as u
+    if obs_location is None:
+        import roo_vs_ephemeris
+        obs_location = roo_vs_ephemeris.get_obs_location()
+    return np.array([obs_location.x.to_value(u.km), obs_location.y.to_value(u.km), obs_location.z.to_value(u.km)])
+
+# GCRS vectors (3, n) from the observer to satellite ITRS positions (km)
+def topocentric(satellite_itrs_x, satellite_itrs_y, satellite_itrs_z, telescope_datetime, obs_location=None):
+    satellite_itrs = np.array([satellite_itrs_x, satellite_itrs_y, satellite_itrs_z], dtype=float)
+    return itrs_to_gcrs(satellite_itrs - observer_itrs(obs_location)[:, None], telescope_datetime)
+
+# Same interface (and results, to the accuracy above) as roo_vs_ephemeris.transform_batch
+def transform_batch(satellite_itrs_x, satellite_itrs_y, satellite_itrs_z, telescope_datetime, obs_location=None):
+    obsloc_to_sat_r = topocentric(satellite_itrs_x, satellite_itrs_y, satellite_itrs_z, telescope_datetime, obs_location)
+    topo_dist = np.linalg.norm(obsloc_to_sat_r, axis=0)
+    topo_rav = np.degrees(np.arctan2(obsloc_to_sat_r[1], obsloc_to_sat_r[0]))
+    topo_decv = np.degrees(np.arcsin(obsloc_to_sat_r[2]/topo_dist))
+    topo_rav = np.where(topo_rav < 0, topo_rav + 360, topo_rav)
+    return topo_rav, topo_decv
@@ -0,0 +1,134 @@
+import os
+import numpy as np
+import fileutils
+import results_store
+# astropy, pandas and pyarrow are imported inside the functions that use them
+
+# Plate-solve index
+# Scans a tree of astrometry.net outputs (solve-field's <frame>.corr/<frame>.wcs, or corr.fits/wcs.fits in a folder per
+# frame as nova.astrometry.net hands them out) and keeps one row per frame: its mid-exposure time, satellite, number of
+# matched stars and the RMS of the field - index star positions in x/y (pixels) and RA/DEC (arcsec).
+# The RMS of every new frame is computed in one pass over all their correspondence tables stacked together.
+# The index is a Parquet file keyed by frame; only corr files that are new or changed (size/mtime) are read again,
+# and frames whose corr file is gone are dropped. join_results() matches it to the comparison results by timestamp.
+
+astrometry_folder = "astrometry_solves/" # Choose the folder (tree) of astrometry.net outputs
+index_file = "plate_solve_index.parquet" # Choose where to keep the index
+join_tolerance = np.timedelta64(1, 's') # Largest time difference between a frame and a comparison sample when joining
+
+frame_extensions = [".fit", ".fits", ".fts", ".new"]
+index_columns = ["frame", "path", "size", "mtime_ns", "timestamp", "satellite", "matches", "rms_x", "rms_y", "rms_ra", "rms_dec", "rms"]
+
+# (frame id, corr file, wcs file) of every solve in the tree
+def find_solves(root):
+    solves = []
+    for folder, _, files in os.walk(root):
+        for name in sorted(files):
+            if name.endswith(".corr"):
+                stem = name[:-len(".corr")]
+                solves.append((stem, os.path.join(folder, name), os.path.join(folder, stem + ".wcs")))
+            elif name == "corr.fits":
+                solves.append((os.path.basename(folder), os.path.join(folder, name), os.path.join(folder, "wcs.fits")))
+    return solves
+
+# Mid-exposure time of a frame from the DATE-OBS in its wcs file, or in the original frame next to it (NaT if neither has one)
+def solve_time(corr_path, wcs_path):
+    from astropy.io import fits
+    import satellite_centroid
+    stem = os.path.splitext(corr_path)[0]
+    for path in [wcs_path] + [stem + extension for extension in frame_extensions]:
+        if os.path.isfile(path):
+            header = fits.getheader(path)
+            if "DATE-OBS" in header:
+                return satellite_centroid.frame_time(header)
+    return np.datetime64("NaT", "ns")
+
+def solve_satellite(frame):
+    import satellite_centroid
+    import roo_vs_ephemeris
+    satellite = satellite_centroid.frame_satellite(frame)
+    return roo_vs_ephemeris.satellite_names.get(satellite)
+
+# Per-frame RMS of the correspondence tables at corr_paths, computed on all of them stacked together
+def solve_rms(corr_paths):
+    from astropy.io import fits
+    tables = []
+    for corr_path in corr_paths:
+        with fits.open(corr_path) as corr:
+            tables.append(np.asarray(corr[1].data) if len(corr) > 1 and corr[1].data is not None else None)
+    matches = np.array([0 if table is None else len(table) for table in tables])
+    tables = [table for table in tables if table is not None and len(table) > 0]
+    frame = np.repeat(np.arange(len(corr_paths)), matches)
+    columns = {name: np.concatenate([table[name] for table in tables]).astype(float) if tables else np.empty(0)
+               for name in ["field_x", "field_y", "index_x", "index_y", "field_ra", "field_dec", "index_ra", "index_dec"]}
+
+    dx = columns["field_x"] - columns["index_x"]
+    dy = columns["field_y"] - columns["index_y"]
+    dra = (columns["field_ra"] - columns["index_ra"] + 180) % 360 - 180
+    dra = dra * np.cos(np.radians(columns["index_dec"])) * 3600
+    ddec = (columns["field_dec"] - columns["index_dec"]) * 3600
+
+    def rms(values):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.sqrt(np.bincount(frame, values**2, minlength=len(corr_paths)) / matches)
+
+    return {"matches": matches, "rms_x": rms(dx), "rms_y": rms(dy), "rms_ra": rms(dra), "rms_dec": rms(ddec), "rms": rms(np.hypot(dra, ddec))}
+
+def read_index(index_path=index_file):
+    import pandas as pd
+    if not os.path.isfile(index_path):
+        return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in
+                             zip(index_columns, [object, object, np.int64, np.int64, "datetime64[ns]", object, np.int64, float, float, float, float, float])})
+    return pd.read_parquet(index_path)
+
+# Written to a temporary file and renamed into place, so an interrupted run never leaves half an index
+def write_index(index, index_path=index_file):
+    fileutils.atomic_write(index_path, lambda tmp_path: index.to_parquet(tmp_path, index=False), ".parquet")
+
+# Brings the index up to date with the tree at root, returns it
+def update_index(root=astrometry_folder, index_path=index_file):
+    import pandas as pd
+    index = read_index(index_path)
+    solves = find_solves(root)
+    seen = {frame for frame, _, _ in solves}
+    known = {row.frame: (row.path, row.size, row.mtime_ns) for row in index.itertuples()}
+    changed = []
+    for frame, corr_path, wcs_path in solves:
+        stat = os.stat(corr_path)
+        if known.get(frame) != (corr_path, stat.st_size, stat.st_mtime_ns):
+            changed.append((frame, corr_path, wcs_path, stat))
+    print(str(len(changed)) + " of " + str(len(solves)) + " plate solves new or changed")
+
+    kept = index["frame"].isin(seen)
+    if not changed and kept.all():
+        print("Done :D Index in " + index_path + " is up to date (" + str(len(index)) + " plate solves)")
+        return index
+    index = index[kept & ~index["frame"].isin([frame for frame, _, _, _ in changed])]
+    if changed:
+        rms = solve_rms([corr_path for _, corr_path, _, _ in changed])
+        solved = pd.DataFrame({
+            "frame": [frame for frame, _, _, _ in changed],
+            "path": [corr_path for _, corr_path, _, _ in changed],
+            "size": np.array([stat.st_size for _, _, _, stat in changed], dtype=np.int64),
+            "mtime_ns": np.array([stat.st_mtime_ns for _, _, _, stat in changed], dtype=np.int64),
+            "timestamp": np.array([solve_time(corr_path, wcs_path) for _, corr_path, wcs_path, _ in changed], dtype="datetime64[ns]"),
+            "satellite": [solve_satellite(frame) for frame, _, _, _ in changed],
+            **rms,
+        })
+        index = pd.concat([index, solved], ignore_index=True) if len(index) else solved
+    index = index.sort_values("frame").reset_index(drop=True)
+    write_index(index, index_path)
+    print("Done :D " + str(len(index)) + " plate solves indexed in " + index_path)
+    return index
+
+# The index joined to the nearest comparison sample (same satellite, within tolerance) of the results store at root
+def join_results(index, root=results_store.results_folder, offset_ms=0, tolerance=join_tolerance):
+    import pandas as pd
+    comparison = results_store.read_results(root, columns=["file", "satellite", "date", "timestamp", "ra_diff", "dec_diff"], offset_ms=offset_ms)
+    index = index.dropna(subset=["timestamp", "satellite"]).astype({"satellite": comparison["satellite"].dtype})
+    joined = pd.merge_asof(index.sort_values("timestamp"), comparison.sort_values("timestamp"), on="timestamp", by="satellite",
+                           direction="nearest", tolerance=pd.Timedelta(tolerance))
+    return joined.dropna(subset=["ra_diff"]).reset_index(drop=True)
+
+if __name__ == "__main__":
+    update_index(astrometry_folder, index_file)
@@ -0,0 +1,126 @@
+import os
+import re
+import numpy as np
+import timeutils
+# pandas/pyarrow are imported inside the functions that use them
+
+# Columnar comparison results
+# Results are kept as a Parquet dataset, hive-partitioned as <root>/satellite=QZS1/date=220302/offset_ms=0/<file>.part-0.parquet,
+# one part per observation file per partition (<file>.part-<n>-0.parquet for the n-th chunk when streaming). Writers call
+# clear_results() first, so rerunning a file replaces its previous results.
+# The .part- separator keeps the names unambiguous: a file's parts never match another file whose name starts with the same stem.
+# read_results() only reads the requested columns and partitions.
+
+results_folder = "comparison_results/" # Choose where to keep the comparison results
+
+partition_columns = ["satellite", "date", "offset_ms"]
+columns = ["file", "sv", "timestamp", "telescope_ra", "telescope_dec", "ephemeris_ra", "ephemeris_dec", "ra_diff", "dec_diff"]
+
+def partitioning():
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    return ds.partitioning(pa.schema([("satellite", pa.string()), ("date", pa.string()), ("offset_ms", pa.int32())]), flavor="hive")
+
+def schema():
+    import pyarrow as pa
+    return pa.schema([
+        ("file", pa.string()),
+        ("sv", pa.string()),
+        ("timestamp", pa.timestamp("ns")),
+        ("telescope_ra", pa.float64()),
+        ("telescope_dec", pa.float64()),
+        ("ephemeris_ra", pa.float64()),
+        ("ephemeris_dec", pa.float64()),
+        ("ra_diff", pa.float64()),
+        ("dec_diff", pa.float64()),
+        ("satellite", pa.string()),
+        ("date", pa.string()),
+        ("offset_ms", pa.int32()),
+    ])
+
+# Results table of one observation file (every offset_ms row of offsets, if several)
+def comparison_table(file_name, satellite, sv, date, offset_ms, telescope_datetime, telescope_ra, telescope_dec, ephemeris_ra, ephemeris_dec):
+    import pandas as pd
+    return pd.DataFrame({
+        "file": file_name,
+        "sv": sv,
+        "timestamp": np.asarray(telescope_datetime, dtype="datetime64[ns]"),
+        "telescope_ra": telescope_ra,
+        "telescope_dec": telescope_dec,
+        "ephemeris_ra": ephemeris_ra,
+        "ephemeris_dec": ephemeris_dec,
+        "ra_diff": (np.asarray(ephemeris_ra) - telescope_ra) * 3600,
+        "dec_diff": (np.asarray(ephemeris_dec) - telescope_dec) * 3600,
+        "satellite": satellite,
+        "date": date,
+        "offset_ms": offset_ms,
+    })
+
+def partition_folder(root, satellite, date, offset_ms):
+    return os.path.join(root, "satellite=" + satellite, "date=" + date, "offset_ms=" + str(int(offset_ms)))
+
+# Names of the parts written for an observation file: <stem>.part-<i>.parquet or <stem>.part-<n>-<i>.parquet
+def part_pattern(file_name):
+    return re.compile(re.escape(os.path.splitext(file_name)[0]) + r"\.part(-\d+)?-\d+\.parquet")
+
+# Deletes the parts written for an observation file in the given partitions (every offset in offsets_ms)
+def clear_results(root, file_name, satellite, date, offsets_ms):
+    part = part_pattern(file_name)
+    for offset_ms in np.atleast_1d(offsets_ms):
+        folder = partition_folder(root, satellite, date, offset_ms)
+        if os.path.isdir(folder):
+            for name in os.listdir(folder):
+                if part.fullmatch(name):
+                    os.remove(os.path.join(folder, name))
+
+# Whether any part of an observation file is in the partition
+def has_results(root, file_name, satellite, date, offset_ms):
+    part = part_pattern(file_name)
+    folder = partition_folder(root, satellite, date, offset_ms)
+    return os.path.isdir(folder) and any(part.fullmatch(name) for name in os.listdir(folder))
+
+# part numbers the chunks of a file written one after another (streaming)
+def write_results(table, root=results_folder, part=None):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    basename = os.path.splitext(table["file"].iloc[0])[0] + ".part" + ("" if part is None else "-" + str(part))
+    ds.write_dataset(pa.Table.from_pandas(table, schema=schema(), preserve_index=False), root, format="parquet",
+                     partitioning=partitioning(), basename_template=basename + "-{i}.parquet", existing_data_behavior="overwrite_or_ignore")
+
+# Query API: only the requested columns (all if None) of the matching rows as a DataFrame
+# satellite/date/offset_ms/file take a single value or a list of values
+def read_results(root=results_folder, columns=None, satellite=None, date=None, offset_ms=None, file=None):
+    import pyarrow.dataset as ds
+    if not os.path.isdir(root):
+        raise FileNotFoundError("No comparison results in " + str(root))
+    dataset = ds.dataset(root, format="parquet", partitioning=partitioning(), schema=schema())
+    conditions = []
+    for name, value in [("satellite", satellite), ("date", date), ("offset_ms", offset_ms), ("file", file)]:
+        if value is None:
+            continue
+        values = list(value) if isinstance(value, (list, tuple, set, np.ndarray)) else [value]
+        values = [value.item() if isinstance(value, np.generic) else value for value in values]
+        conditions.append(ds.field(name).isin(values))
+    condition = None
+    for expression in conditions:
+        condition = expression if condition is None else condition & expression
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+# Distinct values of the partition columns present in the store, e.g. every (satellite, date) pair
+def partitions(root=results_folder, names=("satellite", "date")):
+    return read_results(root, columns=list(names)).drop_duplicates().sort_values(list(names)).reset_index(drop=True)
+
+# Imports an old "<offset>ms_compared_<file>" csv written by np.savetxt into the store
+def import_comparison_csv(path, satellite, root=results_folder):
+    import pandas as pd
+    file_name = os.path.basename(path)
+    match = re.match(r"(-?\d+)ms_compared_(.*)", file_name)
+    offset_ms = int(match.group(1)) if match else 0
+    file_name = match.group(2) if match else file_name
+    comparison = pd.read_csv(path)
+    telescope_datetime = timeutils.parse_timestamps(comparison["Timestamp"].to_numpy())
+    table = comparison_table(file_name, satellite, None, pd.Timestamp(telescope_datetime[0]).strftime("%y%m%d"), offset_ms, telescope_datetime,
+                             comparison["Telescope RA"].to_numpy(), comparison["Telescope DEC"].to_numpy(), comparison["Ephemeris RA"].to_numpy(), comparison["Ephemeris DEC"].to_numpy())
+    clear_results(root, file_name, satellite, table["date"].iloc[0], offset_ms)
+    write_results(table, root)
+    return table
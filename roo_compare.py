@@ -0,0 +1,90 @@
+import argparse
+from datetime import timedelta
+
+# roo-compare: command line entry point for the telescope vs ephemeris comparison
+# Only argparse is imported up front; the backend modules (and astropy/skyfield with them) are imported once the
+# arguments have been parsed, so --help returns immediately.
+
+backends = ["astropy", "skyfield", "precomputed"]
+
+# Offsets in ms, either single values or start:stop:step ranges (stop excluded, like np.arange)
+def parse_offsets(values):
+    offsets = []
+    for value in values:
+        if ":" in value:
+            start, stop, step = (int(part) for part in value.split(":"))
+            offsets += list(range(start, stop, step))
+        else:
+            offsets.append(int(value))
+    return offsets
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="roo-compare", description="Compare ROO telescope RA/DEC observations against interpolated SP3 ephemerides.")
+    parser.add_argument("--ephemeris-folder", default="qzr_ephemeris/", help="where SP3 files are kept/downloaded to (default: %(default)s)")
+    parser.add_argument("--telescope-data-folder", default="telescope_data/", help="folder of telescope observation csvs (default: %(default)s)")
+    parser.add_argument("--output-dir", default=None, help="results store to save the comparisons to (default: comparison_results/, or comparison_results_skyfield/ for the skyfield backend)")
+    parser.add_argument("--ephemeris-type", choices=["final", "rapid"], default="final", help="QZSS ephemeris product, final falls back to rapid when missing (default: %(default)s)")
+    parser.add_argument("--ephemeris-mirror", default=None, metavar="DIR", help="local folder of SP3 files to use before downloading")
+    parser.add_argument("--ephemeris-url", nargs=2, action="append", metavar=("PRODUCT", "URL"), help="base URL to download a product (final or rapid) from instead of the QZSS archive")
+    parser.add_argument("--offsets", nargs="+", default=["0"], metavar="MS", help="timing offsets in ms added to the telescope timestamps; ranges as start:stop:step, e.g. --offsets=-1000:1000:100 (default: 0)")
+    parser.add_argument("--sweep", metavar="DIR", help="evaluate all offsets in one pass and save them to the results store at DIR")
+    parser.add_argument("--backend", choices=backends, default="astropy", help="coordinate transform backend; precomputed uses cached per-night ITRS -> GCRS tables, within 3e-5 arcsec of astropy (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes (default: %(default)s)")
+    parser.add_argument("--stream", action="store_true", help="process each observation file in chunks, appending results as it goes (bounded memory for very large files)")
+    parser.add_argument("--chunk-size", type=int, default=None, help="samples per chunk (default: 20000)")
+    parser.add_argument("--force", action="store_true", help="recompute every observation file, even ones whose results are up to date")
+    parser.add_argument("--dry-run", action="store_true", help="only list the observation files that would be (re)computed, and why")
+    parser.add_argument("--sp3-cache", default=None, help="folder for the parsed SP3 cache (default: sp3_cache/)")
+    parser.add_argument("--timings", default=None, metavar="FILE", help="log each stage's wall/CPU time and throughput as JSON lines, per file and per run, to FILE (- for stderr)")
+    parser.add_argument("--profile", default=None, metavar="FILE", help="save a cProfile dump of the run (main process only) to FILE")
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        offsets = parse_offsets(args.offsets)
+    except ValueError:
+        parser.error("offsets must be integers (ms) or start:stop:step ranges")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.chunk_size is not None and args.chunk_size < 1:
+        parser.error("--chunk-size must be at least 1")
+    if args.sweep and (args.workers > 1 or args.stream):
+        parser.error("--sweep evaluates each file in one batch, it can't be combined with --workers or --stream")
+
+    import sp3_cache
+    if args.sp3_cache is not None:
+        sp3_cache.cache_folder = args.sp3_cache
+    import sp3_prefetch
+    for product, url in args.ephemeris_url or []:
+        if product not in sp3_prefetch.base_urls:
+            parser.error("--ephemeris-url product must be final or rapid")
+        sp3_prefetch.base_urls[product] = url if url.endswith("/") else url + "/"
+
+    if args.backend == "skyfield":
+        import roo_vs_ephemeris_skyfield as backend
+        options = {}
+    else:
+        import roo_vs_ephemeris as backend
+        options = {"backend": args.backend}
+    backend.ephemeris_type = args.ephemeris_type
+    import roo_vs_ephemeris
+    roo_vs_ephemeris.ephemeris_mirror = args.ephemeris_mirror
+    if args.chunk_size is not None:
+        roo_vs_ephemeris.chunk_size = args.chunk_size
+    output_dir = args.output_dir if args.output_dir is not None else backend.output_dir
+    import timings
+    if args.timings is not None:
+        timings.enabled = True
+        timings.log_file = None if args.timings == "-" else args.timings
+
+    with timings.profile(args.profile):
+        if args.sweep:
+            backend.sweep(args.ephemeris_folder, args.telescope_data_folder, args.sweep, offsets, force=args.force, dry_run=args.dry_run, **options)
+        else:
+            for offset in offsets:
+                backend.main(args.ephemeris_folder, args.telescope_data_folder, output_dir, offset=timedelta(milliseconds=offset), workers=args.workers, stream=args.stream, force=args.force, dry_run=args.dry_run, **options)
+
+if __name__ == "__main__":
+    main()
@@ -1,35 +1,49 @@
-from math import asin, atan2, floor
-import georinex as gr
+from math import asin, atan2
 from pathlib import Path
 import numpy as np
-import pandas as pd
 import glob
 import os
-import shutil
-import numerical_methods as num_meth
-import requests
+import queue
+import threading
+import time
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
+from lagrange import LagrangeInterpolator
+import sp3_cache
+import results_store
+import timeutils
+import ephemeris_source
+import sp3_prefetch
+import manifest
+import timings
 from datetime import datetime, timedelta
 from alive_progress import alive_bar
-from astropy import units as u
-from astropy.coordinates import (SkyCoord, EarthLocation)
-from astropy import coordinates as coord
+# astropy and pandas are imported inside the functions that use them, so importing this module
+# (or running roo-compare --help) stays fast
 
 # CONFIG
 # Place telescope data in <telescope_data_folder>/QZSS1 or QZSS3
 # Program will automatically detect the correct satellite (provided the filename contains the name of the correct satellite)
 # Program will also automatically download and choose the correct ephemeris and save it to <ephemeris_folder> 
-# Might cause problems if the telescope's data includes 2 different days
-# The UTC time, interpolated RA/DEC, telescope RA/DEC and the difference will be saved in csv files under <output_dir>
+# (all the files a run needs are fetched before processing starts, see sp3_prefetch.py)
+# Observations near or across midnight (GPS) use the adjacent daily SP3 files too, stitched into one track
+# The UTC time, interpolated RA/DEC, telescope RA/DEC and the difference will be saved in the results store at <output_dir>
+# (Parquet, partitioned by satellite/date/offset, see results_store.py)
+# Files whose results are already in <output_dir> and whose inputs/parameters haven't changed are skipped (see manifest.py)
+# With timings.enabled each stage's wall/CPU time and throughput is logged as JSON lines, per file and per run (see timings.py)
 
 ephemeris_folder = "qzr_ephemeris/" # Choose location of QZSS ephemeris files
 telescope_data_folder = "telescope_data/" # Choose where to put the telescope obs csvs
 processed_telescope_data = "processed_telescope_data/"
-output_dir = "accuracy_comparison_data/" # Choose where to save final comparison data
-load_sp3 = Path("./load_sp3") # Won't work without this for some reason (for gr.loadsp3() function)
+output_dir = results_store.results_folder # Choose where to save final comparison data
 
-ephemeris_type = "final" # Choose between rapid or final
+ephemeris_type = "final" # Choose between rapid or final (final falls back to rapid for days without a final product)
+ephemeris_mirror = None # Optional local folder of SP3 files to use before downloading
+workers = 1 # Number of processes to spread the observation files over
+chunk_size = 20000 # Large observation files are split into chunks of this many samples
+stream = False # Read/process/write observation files chunk by chunk instead of whole (for very large files)
 
-roo = [-37.680589141*u.deg, 145.061634327*u.deg, 155.083*u.m] # Location of the ROO
+roo = [-37.680589141, 145.061634327, 155.083] # Location of the ROO (latitude/longitude in degrees, height in m)
 
 ####################################################################
 
@@ -40,58 +54,64 @@ QZS4 = "J03"
 PRN5 = "G05"
 PRN18 = "G18"
 
-ephemeris_final_url = "https://sys.qzss.go.jp/archives/final-sp3/"
-ephemeris_rapid_url = "https://sys.qzss.go.jp/archives/rapid-sp3/"
-
-obs_location = EarthLocation.from_geodetic(lat=roo[0], lon=roo[1], height=roo[2], ellipsoid = 'GRS80')
-
-def choose_ephemeris(ephemeris_type, ephemeris_folder, time):
-    gps_fepoch = datetime(1980, 1, 6)
-    time_since_epoch = time - gps_fepoch
-    gps_week = floor(time_since_epoch.total_seconds()/86400 / 7)
-    gps_day = floor(time_since_epoch.total_seconds()/86400) % 7
-    gps_weekday = str(gps_week) + str(gps_day)
-    download_link = None
-    file_path = None
-    file_name = None
-
-    file_name = None
-    year = str(time.year) + "/"
-    if ephemeris_type == "rapid":
-        file_name = "qzr" + gps_weekday + ".sp3"
-        download_link = ephemeris_rapid_url + year + file_name
-        file_path = Path(ephemeris_folder + file_name)
-
-    elif ephemeris_type == "final":
-        file_name = "qzf" + gps_weekday + ".sp3"
-        download_link = ephemeris_final_url + year + file_name
-        file_path = Path(ephemeris_folder + file_name)
-    else:
+satellites = {"qzs1": QZS1, "qzs2": QZS2, "qzs3": QZS3, "qzs4": QZS4, "prn5": PRN5, "prn18": PRN18}
+satellite_names = {satellite: name.upper() for name, satellite in satellites.items()} # e.g. J01 -> QZS1, used as the results partition
+
+@lru_cache(maxsize=None)
+def get_obs_location():
+    from astropy import units as u
+    from astropy.coordinates import EarthLocation
+    return EarthLocation.from_geodetic(lat=roo[0]*u.deg, lon=roo[1]*u.deg, height=roo[2]*u.m, ellipsoid = 'GRS80')
+
+# SP3 file for a GPS week/day (None if there isn't one)
+# Looked up in the prefetched files if given (days that weren't prefetched are fetched and added), otherwise fetched on the spot
+def ephemeris_file(ephemeris_type, ephemeris_folder, gps_week, gps_day, available=None):
+    if ephemeris_type not in ["rapid", "final"]:
         print("Please choose a valid ephemeris!")
+        raise ValueError("Unknown ephemeris type " + str(ephemeris_type))
+    if available is not None:
+        if (gps_week, gps_day) not in available:
+            available.update(prefetch_ephemerides(ephemeris_type, ephemeris_folder, [(gps_week, gps_day)]))
+        return available[(gps_week, gps_day)]
+    return prefetch_ephemerides(ephemeris_type, ephemeris_folder, [(gps_week, gps_day)])[(gps_week, gps_day)]
 
-    if file_path.is_file():
-        print(file_name + " already exists, using")
-    else:
-        print("Downloading final ephemeris " + download_link + "...")
-        ephemeris_file = requests.get(download_link, allow_redirects=True)
-        open(ephemeris_folder + file_name, 'wb').write(ephemeris_file.content)
-    
-    return file_path
-    #return Path(ephemeris_folder + "igr22246.sp3")
-
-def interpolate(x, y, z, satellite_time_utc, telescope_datetime):
-    satellite_time_utc_timestamp = np.array([pd.to_datetime([time]).astype(int) / 10**6 for time in satellite_time_utc]).flatten()
-    telescope_datetime_timestamp = np.array([pd.to_datetime([str(time)]).astype(int) / 10**6 for time in telescope_datetime]).flatten()
-    x_interp = []
-    y_interp = []
-    z_interp = []
-    for time in telescope_datetime_timestamp:
-        x_interp.append(num_meth.interp_lagrange(satellite_time_utc_timestamp, x, time, 9)[0])
-        y_interp.append(num_meth.interp_lagrange(satellite_time_utc_timestamp, y, time, 9)[0])
-        z_interp.append(num_meth.interp_lagrange(satellite_time_utc_timestamp, z, time, 9)[0])
-    return x_interp, y_interp, z_interp
+# Fetches every SP3 file for the given GPS (week, day)s before processing, returns {(week, day): path or None}
+def prefetch_ephemerides(ephemeris_type, ephemeris_folder, days, offline=False):
+    return sp3_prefetch.prefetch(days, ephemeris_type, ephemeris_folder, mirror=ephemeris_mirror, offline=offline)
+
+# Prefetch for a set of observations, given as (start, end) UTC datetime64 ranges
+def prefetch_observations(ephemeris_type, ephemeris_folder, ranges):
+    required, margin = sp3_prefetch.observation_days(ranges)
+    print("Fetching " + str(len(required) + len(margin)) + " ephemeris files...")
+    available = prefetch_ephemerides(ephemeris_type, ephemeris_folder, required | margin)
+    for gps_week, gps_day in sorted(required):
+        if available[(gps_week, gps_day)] is None:
+            print("No " + ephemeris_type + " ephemeris for GPS week " + str(gps_week) + " day " + str(gps_day))
+    return available
+
+# SP3 files covering [start, end] (UTC datetime64) plus the interpolation margin, as a tuple for track_interpolator
+# Days only needed for the margin are left out if they aren't available, the track then just ends at that midnight
+def choose_ephemerides(ephemeris_type, ephemeris_folder, start, end, available=None):
+    if available is None:
+        available = prefetch_observations(ephemeris_type, ephemeris_folder, [(start, end)])
+    required = ephemeris_source.days_needed(start, end, margin=np.timedelta64(0, 's'))
+    paths_to_sp3 = []
+    for gps_week, gps_day in ephemeris_source.days_needed(start, end):
+        path_to_sp3 = ephemeris_file(ephemeris_type, ephemeris_folder, gps_week, gps_day, available)
+        if path_to_sp3 is None and (gps_week, gps_day) in required:
+            raise FileNotFoundError("No " + ephemeris_type + " ephemeris for GPS week " + str(gps_week) + " day " + str(gps_day))
+        if path_to_sp3 is not None:
+            paths_to_sp3.append(str(path_to_sp3))
+    return tuple(paths_to_sp3)
+
+def interpolate(interpolator, telescope_datetime):
+    satellite_itrs = interpolator(np.asarray(telescope_datetime, dtype='datetime64[ns]'))
+    return satellite_itrs[:, 0], satellite_itrs[:, 1], satellite_itrs[:, 2]
 
 def transform(satellite_itrs_x, satellite_itrs_y, satellite_itrs_z, telescope_datetime, obs_location):
+    from astropy import units as u
+    from astropy.coordinates import SkyCoord
+    from astropy import coordinates as coord
     satellite_itrs = SkyCoord(x=satellite_itrs_x*u.km, y=satellite_itrs_y*u.km, z=satellite_itrs_z*u.km, frame='itrs', obstime=telescope_datetime)
     satellite_gcrs = satellite_itrs.transform_to(coord.GCRS(obstime=telescope_datetime))
 
@@ -112,84 +132,437 @@ def transform(satellite_itrs_x, satellite_itrs_y, satellite_itrs_z, telescope_da
 
     return topo_rav, topo_decv
     
-def extract_ephemeris(satellite, sp3):
-    satellite_itrs_x = sp3.sel(sv=satellite).position.sel(ECEF='x').to_numpy()
-    satellite_itrs_y = sp3.sel(sv=satellite).position.sel(ECEF='y').to_numpy()
-    satellite_itrs_z = sp3.sel(sv=satellite).position.sel(ECEF='z').to_numpy()
-    satellite_time_gps = sp3.sel(sv=satellite).position.time.to_numpy()
-    return satellite_itrs_x, satellite_itrs_y, satellite_itrs_z, satellite_time_gps
-    
-def interpolate_transform(satellite, telescope_datetime, ephemeris_folder, offset):
-    path_to_sp3 = choose_ephemeris(ephemeris_type, ephemeris_folder, telescope_datetime[0])
-    sp3 = gr.load_sp3(path_to_sp3, load_sp3)
-    ephemeris_ra = []
-    ephemeris_dec = []
-    satellite_itrs_x, satellite_itrs_y, satellite_itrs_z, satellite_time_gps = extract_ephemeris(satellite, sp3)
-    satellite_time_utc = []
-    for time in satellite_time_gps:
-        satellite_time_utc.append(time - np.timedelta64(18000, 'ms'))
-        
-    x_interp, y_interp, z_interp = interpolate(satellite_itrs_x, satellite_itrs_y, satellite_itrs_z, satellite_time_utc, telescope_datetime)
-    no_coordinates = len(x_interp)
-    print("Transforming...")
-    with alive_bar(no_coordinates) as bar:
-        for i in range(no_coordinates):
-            ra, dec = transform(x_interp[i], y_interp[i], z_interp[i], telescope_datetime[i], obs_location)
-            ephemeris_ra.append(ra)
-            ephemeris_dec.append(dec)
-            bar()
+# Same as transform() but for whole arrays of positions/obstimes in a single astropy transform
+# The observer's GCRS position is computed once for the batch rather than once per sample
+def transform_batch(satellite_itrs_x, satellite_itrs_y, satellite_itrs_z, telescope_datetime, obs_location):
+    from astropy import units as u
+    from astropy import coordinates as coord
+    from astropy.time import Time
+    jd, fraction = timeutils.julian_date(timeutils.utc_to_tt(telescope_datetime))
+    obstime = Time(jd, fraction, format='jd', scale='tt') # UTC -> TT from the leap second table in timeutils
+    no_coordinates = len(obstime)
+    gcrs_frame = coord.GCRS(obstime=obstime)
+
+    satellite_itrs = coord.ITRS(x=np.asarray(satellite_itrs_x, dtype=float)*u.km, y=np.asarray(satellite_itrs_y, dtype=float)*u.km, z=np.asarray(satellite_itrs_z, dtype=float)*u.km, obstime=obstime, representation_type='cartesian')
+    satellite_gcrs = satellite_itrs.transform_to(gcrs_frame).cartesian.xyz.to_value(u.km)
+
+    obsloc_itrs = coord.ITRS(x=np.full(no_coordinates, obs_location.x.to_value(u.km))*u.km, y=np.full(no_coordinates, obs_location.y.to_value(u.km))*u.km, z=np.full(no_coordinates, obs_location.z.to_value(u.km))*u.km, obstime=obstime, representation_type='cartesian')
+    obsloc_gcrs = obsloc_itrs.transform_to(gcrs_frame).cartesian.xyz.to_value(u.km)
+
+    obsloc_to_sat_r = satellite_gcrs - obsloc_gcrs
+    topo_dist = np.linalg.norm(obsloc_to_sat_r, axis=0)
+    topo_rav = np.degrees(np.arctan2(obsloc_to_sat_r[1], obsloc_to_sat_r[0]))
+    topo_decv = np.degrees(np.arcsin(obsloc_to_sat_r[2]/topo_dist))
+    topo_rav = np.where(topo_rav < 0, topo_rav + 360, topo_rav)
+
+    return topo_rav, topo_decv
+
+# One interpolator per satellite track (one or more stitched SP3 files), reused by every file/offset that needs it
+@lru_cache(maxsize=32)
+def track_interpolator(paths_to_sp3, satellite):
+    if isinstance(paths_to_sp3, (str, Path)):
+        paths_to_sp3 = (str(paths_to_sp3),)
+    satellite_time_gps, satellite_itrs = ephemeris_source.merged_track(tuple(paths_to_sp3), satellite)
+    satellite_time_utc = timeutils.gps_to_utc(satellite_time_gps)
+    return LagrangeInterpolator(satellite_time_utc, satellite_itrs)
+
+# Ephemeris RA/DEC for one chunk of telescope timestamps
+# Top-level so it can run in a worker process: only the SP3 paths and satellite name are pickled,
+# the track itself is memory-mapped from the SP3 cache in each process.
+def compare_chunk(paths_to_sp3, satellite, telescope_datetime, backend="astropy"):
+    with timings.stage("sp3_load"):
+        interpolator = track_interpolator(paths_to_sp3, satellite)
+    with timings.stage("interpolate", len(telescope_datetime)):
+        x_interp, y_interp, z_interp = interpolate(interpolator, telescope_datetime)
+    backend_transform_batch, obs_location = backend_transform(backend)
+    with timings.stage("transform", len(telescope_datetime)):
+        return backend_transform_batch(x_interp, y_interp, z_interp, telescope_datetime, obs_location)
+
+# compare_chunk on the pool; with timings on, the worker's stage timings come back with the result and go into stages
+def submit_chunk(pool, paths_to_sp3, satellite, telescope_datetime, backend="astropy"):
+    if timings.enabled:
+        return pool.submit(timings.collect, compare_chunk, paths_to_sp3, satellite, telescope_datetime, backend)
+    return pool.submit(compare_chunk, paths_to_sp3, satellite, telescope_datetime, backend)
+
+def chunk_result(future, stages):
+    if timings.enabled:
+        result, worker_stages = future.result()
+        timings.merge(stages, worker_stages)
+        return result
+    return future.result()
+
+# Batch transform function and observer location of a coordinate backend (astropy, skyfield or precomputed)
+# precomputed is astropy's transform from cached per-night rotation tables (see observer_geometry.py)
+def backend_transform(backend):
+    if backend == "skyfield":
+        import roo_vs_ephemeris_skyfield
+        return roo_vs_ephemeris_skyfield.transform_batch, roo_vs_ephemeris_skyfield.get_obs_location()
+    elif backend == "astropy":
+        return transform_batch, get_obs_location()
+    elif backend == "precomputed":
+        import observer_geometry
+        return observer_geometry.transform_batch, get_obs_location()
+    raise ValueError("Unknown backend " + str(backend) + ", choose between astropy, skyfield or precomputed")
+
+def init_worker(cache_folder):
+    sp3_cache.cache_folder = cache_folder
+
+# Satellite name for a telescope observation file (None if the file name doesn't contain one)
+def file_satellite(file):
+    for name, satellite in satellites.items():
+        if name in os.path.basename(file):
+            return satellite
+    return None
+
+# Only the timestamp, RA and DEC columns of a telescope csv are parsed
+telescope_csv = dict(header=None, skiprows=1, usecols=[0, 3, 4], dtype={0: object, 3: float, 4: float}, float_precision="round_trip")
+
+def telescope_columns(telescope_obs_file):
+    return timeutils.parse_timestamps(telescope_obs_file[0].to_numpy()), telescope_obs_file[3].to_numpy(), telescope_obs_file[4].to_numpy()
+
+# Timestamps (datetime64[ns], UTC), RA and DEC (degrees) from a telescope observation csv
+def read_telescope_file(file):
+    import pandas as pd
+    return telescope_columns(pd.read_csv(file, **telescope_csv))
+
+# The same, chunk_size rows at a time. Chunks are read and parsed on a background thread, so the next chunk
+# is being read while the current one is processed; at most two chunks are waiting at any time.
+def stream_telescope_file(file, chunk_size, stages=None):
+    import pandas as pd
+    chunks = queue.Queue(maxsize=2)
+    stop = threading.Event()
+
+    def reader():
+        telescope_obs_chunks = None
+        try:
+            telescope_obs_chunks = pd.read_csv(file, chunksize=chunk_size, **telescope_csv)
+            while not stop.is_set():
+                with timings.stage("read", record=stages) as timed:
+                    telescope_obs_file = next(telescope_obs_chunks, None)
+                    if telescope_obs_file is None:
+                        break
+                    chunk = telescope_columns(telescope_obs_file)
+                    timed["samples"] = len(chunk[0])
+                chunks.put(chunk)
+            chunks.put(None)
+        except BaseException as error:
+            chunks.put(error)
+        finally:
+            if telescope_obs_chunks is not None:
+                telescope_obs_chunks.close()
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield chunk
+    finally:
+        # If the caller stopped early, tell the reader to stop and empty the queue so a put it's blocked on returns
+        stop.set()
+        while thread.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        thread.join()
+
+# First and last timestamps of a telescope csv from its first and last lines, without reading the rest of it
+def telescope_time_range(file):
+    with open(file, "rb") as telescope_obs_file:
+        telescope_obs_file.readline()
+        first = telescope_obs_file.readline()
+        telescope_obs_file.seek(0, os.SEEK_END)
+        telescope_obs_file.seek(max(telescope_obs_file.tell() - 4096, 0))
+        last = [line for line in telescope_obs_file.read().splitlines() if line.strip()][-1]
+    times = timeutils.parse_timestamps([line.split(b",")[0].decode() for line in [first, last]])
+    return times.min(), times.max()
 
-    return ephemeris_ra, ephemeris_dec
+# Date of an observation (yymmdd, as in the telescope file names) for the results partition
+def observation_date(telescope_datetime):
+    return telescope_datetime[0].astype('datetime64[D]').astype(datetime).strftime('%y%m%d')
 
-def main(ephemeris_folder, telescope_data_folder, output_dir, offset):
-    telescope_obs_files = glob.glob(telescope_data_folder + "*.csv")
+# telescope_datetime already has the offset added; the partition date is taken from the unshifted timestamps
+def write_comparison(output_dir, file_name, satellite, offset_ms, telescope_datetime, telescope_ra, telescope_dec, ephemeris_ra, ephemeris_dec):
+    date = observation_date(timeutils.apply_offset(telescope_datetime, -offset_ms))
+    table = results_store.comparison_table(file_name, satellite_names[satellite], satellite, date, offset_ms,
+                                           telescope_datetime, telescope_ra, telescope_dec, ephemeris_ra, ephemeris_dec)
+    results_store.clear_results(output_dir, file_name, satellite_names[satellite], date, offset_ms)
+    results_store.write_results(table, output_dir)
+    print("Done :D Final data for " + file_name + " (" + str(offset_ms) + "ms) saved in " + output_dir + "\n")
+    return date
 
+# Which observation files need (re)computing for these offsets according to the manifest in output_dir: new files,
+# changed files or parameters, changed SP3 files (e.g. a final product replacing rapid) or missing results.
+# Returns [(file, satellite)] to process; with dry_run nothing is downloaded and the plan is only printed.
+# processed is the manifest loaded from output_dir
+def plan(ephemeris_folder, telescope_obs_files, output_dir, processed, offsets_ms, backend="astropy", force=False, dry_run=False):
+    telescope_obs, reasons, unchanged = [], {}, []
     for file in telescope_obs_files:
         file_name = os.path.basename(file)
-        print("Reading telescope observation file " + file_name + "...")
-        telescope_obs_file = np.genfromtxt(file, delimiter = ",", dtype = None, encoding='utf-8')
-        telescope_datetime = np.array([datetime.strptime(time, '%Y-%m-%dT%H:%M:%S.%f') + offset for time in telescope_obs_file[1:, 0]])
-        telescope_ra = telescope_obs_file[1:, 3].astype(float)
-        telescope_dec = telescope_obs_file[1:, 4].astype(float)
-        if ("qzs1" in file):
-            satellite = QZS1
-            ephemeris_ra, ephemeris_dec = interpolate_transform(satellite, telescope_datetime, ephemeris_folder, offset)
-        elif ("qzs2" in file):
-            satellite = QZS2
-            ephemeris_ra, ephemeris_dec = interpolate_transform(satellite, telescope_datetime, ephemeris_folder, offset)
-        elif ("qzs3" in file):
-            satellite = QZS3
-            ephemeris_ra, ephemeris_dec = interpolate_transform(satellite, telescope_datetime, ephemeris_folder, offset)
-        elif ("qzs4" in file):
-            satellite = QZS4
-            ephemeris_ra, ephemeris_dec = interpolate_transform(satellite, telescope_datetime, ephemeris_folder, offset)
-        elif ("prn5" in file):
-            satellite = PRN5
-            ephemeris_ra, ephemeris_dec = interpolate_transform(satellite, telescope_datetime, ephemeris_folder, offset)
-        elif ("prn18" in file):
-            satellite = PRN18
-            ephemeris_ra, ephemeris_dec = interpolate_transform(satellite, telescope_datetime, ephemeris_folder, offset)
-
-        telescope_datetime_timestamp = np.array([(datetime.strptime(time, '%Y-%m-%dT%H:%M:%S.%f') + offset).isoformat() for time in telescope_obs_file[1:, 0]])
-        ra_difference = np.subtract(ephemeris_ra, telescope_ra) * 3600
-        dec_difference = np.subtract(ephemeris_dec, telescope_dec) * 3600
-        heading = ["Timestamp", "Telescope RA", "Telescope DEC", "Ephemeris RA", "Ephemeris DEC", "RA Difference", "DEC Difference"]
-        final_data = np.stack((telescope_datetime_timestamp, telescope_ra, telescope_dec, ephemeris_ra, ephemeris_dec, ra_difference, dec_difference), axis=1)
-        formatted_data = np.vstack((heading, final_data))
-        print(offset)
-        print(offset.microseconds)
-        if offset < timedelta(seconds = 0):
-            output_file = output_dir + str(int(offset.microseconds / 1000 - 1000)) + "ms_compared_" + file_name
-        elif offset == timedelta(seconds = 1):
-            output_file = output_dir + str(int(offset.seconds * 1000)) + "ms_compared_" + file_name
+        satellite = file_satellite(file)
+        if satellite is None:
+            print("No satellite found in " + file_name + ", skipping")
+            continue
+        telescope_obs.append((file, satellite))
+        for offset_ms in offsets_ms:
+            previous = processed.get(manifest.key(file_name, offset_ms))
+            reason = "forced" if force else manifest.stale(previous, file, backend, ephemeris_type)
+            if reason is None and not results_store.has_results(output_dir, file_name, previous["satellite"], previous["date"], offset_ms):
+                reason = "results missing"
+            if reason is not None:
+                reasons.setdefault(file, reason)
+            else:
+                unchanged.append((file, previous))
+
+    # Only the days with fallback or missing products can hit the network here, the rest are already on disk
+    unchanged = [(file, previous) for file, previous in unchanged if file not in reasons]
+    days = {day for _, previous in unchanged for day in manifest.ephemeris_days(previous)}
+    available = prefetch_ephemerides(ephemeris_type, ephemeris_folder, days, offline=dry_run) if days else {}
+    for file, previous in unchanged:
+        if file not in reasons and manifest.ephemeris_changed(previous, available):
+            reasons[file] = "ephemeris changed"
+
+    for file, _ in telescope_obs:
+        if file in reasons:
+            print(("Would process " if dry_run else "Processing ") + os.path.basename(file) + " (" + reasons[file] + ")")
+    print(str(len(telescope_obs) - len(reasons)) + " of " + str(len(telescope_obs)) + " observation files up to date, skipping them (--force recomputes everything)")
+    return [(file, satellite) for file, satellite in telescope_obs if file in reasons]
+
+# Records in processed (the loaded manifest, saved by the caller) what the results of a file were computed from
+# (days: the GPS days of its time range)
+def record(processed, output_dir, file, satellite, date, offsets_ms, start, end, available, backend="astropy"):
+    file_name = os.path.basename(file)
+    days = ephemeris_source.days_needed(start, end)
+    for offset_ms in offsets_ms:
+        previous = processed.get(manifest.key(file_name, offset_ms))
+        if previous is not None and (previous["satellite"], previous["date"]) != (satellite_names[satellite], date):
+            results_store.clear_results(output_dir, file_name, previous["satellite"], previous["date"], offset_ms)
+        processed[manifest.key(file_name, offset_ms)] = manifest.entry(
+            manifest.fingerprint(file, previous["input"] if previous is not None else None), satellite_names[satellite], date, offset_ms,
+            backend, ephemeris_type, manifest.ephemeris_record(available, days, previous["ephemeris"] if previous is not None else None))
+
+# Streaming: each chunk of the file goes through interpolate -> transform -> diff and is appended to the results store
+# as its own part straight away, so memory stays bounded by chunk_size (times the chunks in flight) whatever the file size.
+# With a pool, up to two chunks per worker are in flight while the next one is being read.
+def stream_file(file, satellite, ephemeris_folder, output_dir, offset, available, bar, pool=None, backend="astropy", stages=None, workers=1):
+    stages = {} if stages is None else stages
+    file_name = os.path.basename(file)
+    offset_ms = int(offset / timedelta(milliseconds=1))
+    date = None
+    start, end = None, None
+    pending = {}
+
+    def write_part(part, telescope_datetime, telescope_ra, telescope_dec, ephemeris_ra, ephemeris_dec):
+        with timings.stage("write", len(telescope_datetime), stages):
+            table = results_store.comparison_table(file_name, satellite_names[satellite], satellite, date, offset_ms,
+                                                   telescope_datetime, telescope_ra, telescope_dec, ephemeris_ra, ephemeris_dec)
+            results_store.write_results(table, output_dir, part)
+        bar(len(telescope_datetime))
+
+    def write_finished(futures):
+        for future in futures:
+            write_part(*pending.pop(future), *chunk_result(future, stages))
+
+    telescope_chunks = stream_telescope_file(file, chunk_size, stages)
+    try:
+        for part, (telescope_datetime, telescope_ra, telescope_dec) in enumerate(telescope_chunks):
+            if date is None:
+                date = observation_date(telescope_datetime)
+                results_store.clear_results(output_dir, file_name, satellite_names[satellite], date, offset_ms)
+            telescope_datetime = timeutils.apply_offset(telescope_datetime, offset)
+            start = telescope_datetime.min() if start is None else min(start, telescope_datetime.min())
+            end = telescope_datetime.max() if end is None else max(end, telescope_datetime.max())
+            with timings.stage("sp3_load", record=stages):
+                paths_to_sp3 = choose_ephemerides(ephemeris_type, ephemeris_folder, telescope_datetime.min(), telescope_datetime.max(), available)
+                for path_to_sp3 in paths_to_sp3:
+                    sp3_cache.load_track(path_to_sp3, satellite)
+
+            if pool is None:
+                write_part(part, telescope_datetime, telescope_ra, telescope_dec, *timings.into(stages, compare_chunk, paths_to_sp3, satellite, telescope_datetime, backend))
+                continue
+            pending[submit_chunk(pool, paths_to_sp3, satellite, telescope_datetime, backend)] = (part, telescope_datetime, telescope_ra, telescope_dec)
+            if len(pending) >= 2 * workers:
+                write_finished(wait(pending, return_when=FIRST_COMPLETED).done)
+    finally:
+        telescope_chunks.close() # Stops the reader thread straight away if a chunk fails part way through the file
+    write_finished(list(pending))
+    print("Done :D Final data for " + file_name + " (" + str(offset_ms) + "ms) saved in " + output_dir)
+    return date, start, end
+
+def main_stream(ephemeris_folder, telescope_obs, output_dir, processed, offset, workers=1, backend="astropy"):
+    offset_ms = int(offset / timedelta(milliseconds=1))
+    run_start, run_stages = time.perf_counter(), {}
+    # Prefetch from the first/last timestamps; chunks outside that range (unsorted files) fetch what they need themselves
+    ranges = [timeutils.apply_offset(np.array(telescope_time_range(file)), offset) for file, _ in telescope_obs]
+    with timings.stage("prefetch", record=run_stages):
+        available = prefetch_observations(ephemeris_type, ephemeris_folder, [(start, end) for start, end in ranges])
+
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(sp3_cache.cache_folder,)) if workers > 1 else None
+    try:
+        with alive_bar() as bar:
+            for recorded, (file, satellite) in enumerate(telescope_obs, 1):
+                print("Streaming telescope observation file " + os.path.basename(file) + "...")
+                file_start, stages = time.perf_counter(), {}
+                try:
+                    date, start, end = stream_file(file, satellite, ephemeris_folder, output_dir, offset, available, bar, pool, backend, stages, workers)
+                except FileNotFoundError as error:
+                    print(str(error) + ", skipping the rest of " + os.path.basename(file))
+                    continue
+                finally:
+                    emit_file_timings(file, stages, file_start, run_stages, offset_ms=offset_ms, backend=backend)
+                if date is not None:
+                    record(processed, output_dir, file, satellite, date, [offset_ms], start, end, available, backend)
+                    manifest.checkpoint(output_dir, processed, recorded)
+    finally:
+        manifest.save(output_dir, processed)
+        if pool is not None:
+            pool.shutdown()
+    emit_run_timings(run_stages, run_start, mode="stream", files=len(telescope_obs), offset_ms=offset_ms, backend=backend, workers=workers)
+
+# (start is None where a file's chunks are computed alongside every other file's, so it has no elapsed time of its own)
+def emit_file_timings(file, stages, start, run_stages, **fields):
+    timings.merge(run_stages, stages)
+    elapsed = {} if start is None else {"wall_s": round(time.perf_counter() - start, 6)}
+    timings.emit("file", stages, file=os.path.basename(file), **fields, **elapsed)
+
+# Throughput over the whole run counts the samples transformed (offsets x observations for a sweep)
+def emit_run_timings(run_stages, start, **fields):
+    elapsed = time.perf_counter() - start
+    samples = run_stages.get("transform", [0.0, 0.0, 0, 0])[2]
+    timings.emit("run", run_stages, **fields, samples=samples, wall_s=round(elapsed, 6), samples_per_s=round(samples / elapsed, 1) if elapsed > 0 else None)
+
+# With workers > 1 the chunks are spread over a process pool; chunks are the same size either way,
+# so the output is identical to a serial run
+# Only new or changed files are processed unless force is set; dry_run lists them without processing anything
+def main(ephemeris_folder, telescope_data_folder, output_dir, offset, workers=1, backend="astropy", stream=False, force=False, dry_run=False):
+    offset_ms = int(offset / timedelta(milliseconds=1))
+    processed = manifest.load(output_dir)
+    telescope_obs_files = plan(ephemeris_folder, sorted(glob.glob(telescope_data_folder + "*.csv")), output_dir, processed, [offset_ms], backend, force, dry_run)
+    if dry_run or not telescope_obs_files:
+        return
+    if stream:
+        return main_stream(ephemeris_folder, telescope_obs_files, output_dir, processed, offset, workers, backend)
+    observations = []
+    chunks = []
+    run_start, run_stages = time.perf_counter(), {}
+    stages = {file: {} for file, _ in telescope_obs_files}
+
+    telescope_obs = []
+    for file, satellite in telescope_obs_files:
+        print("Reading telescope observation file " + os.path.basename(file) + "...")
+        with timings.stage("read", record=stages[file]) as timed:
+            telescope_datetime, telescope_ra, telescope_dec = read_telescope_file(file)
+            timed["samples"] = len(telescope_datetime)
+        telescope_datetime = timeutils.apply_offset(telescope_datetime, offset)
+        telescope_obs.append((file, satellite, telescope_datetime, telescope_ra, telescope_dec))
+    with timings.stage("prefetch", record=run_stages):
+        available = prefetch_observations(ephemeris_type, ephemeris_folder, [(obs[2].min(), obs[2].max()) for obs in telescope_obs])
+
+    for file, satellite, telescope_datetime, telescope_ra, telescope_dec in telescope_obs:
+        file_name = os.path.basename(file)
+        try:
+            with timings.stage("sp3_load", record=stages[file]):
+                paths_to_sp3 = choose_ephemerides(ephemeris_type, ephemeris_folder, telescope_datetime.min(), telescope_datetime.max(), available)
+                for path_to_sp3 in paths_to_sp3:
+                    sp3_cache.load_track(path_to_sp3, satellite) # Fill the on-disk cache here so workers only ever read it
+        except FileNotFoundError as error:
+            print(str(error) + ", skipping " + file_name)
+            continue
+
+        for start in range(0, len(telescope_datetime), chunk_size):
+            chunks.append((len(observations), start, paths_to_sp3, satellite, telescope_datetime[start:start + chunk_size]))
+        observations.append((file, satellite, telescope_datetime, telescope_ra, telescope_dec, np.empty(len(telescope_datetime)), np.empty(len(telescope_datetime))))
+
+    print("Transforming...")
+    with alive_bar(sum(len(chunk[4]) for chunk in chunks)) as bar:
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(sp3_cache.cache_folder,)) as pool:
+                futures = {submit_chunk(pool, paths_to_sp3, satellite, chunk_datetime, backend): (i, start, len(chunk_datetime)) for i, start, paths_to_sp3, satellite, chunk_datetime in chunks}
+                for future in as_completed(futures):
+                    i, start, length = futures[future]
+                    observations[i][5][start:start + length], observations[i][6][start:start + length] = chunk_result(future, stages[observations[i][0]])
+                    bar(length)
         else:
-            output_file = output_dir + str(int(offset.microseconds / 1000)) + "ms_compared_" + file_name
-        if not(os.path.isdir(output_dir)):
-            os.mkdir(output_dir)
-        np.savetxt(output_file, formatted_data, delimiter=',', fmt='%s')
-        print("Done :D Final data saved in " + output_file + "\n")
-        #shutil.move(file, processed_telescope_data + file_name)
-
-offset_datetime = timedelta(milliseconds=int(0))
-main(ephemeris_folder, telescope_data_folder, output_dir, offset = offset_datetime)
+            for i, start, paths_to_sp3, satellite, chunk_datetime in chunks:
+                observations[i][5][start:start + len(chunk_datetime)], observations[i][6][start:start + len(chunk_datetime)] = timings.into(stages[observations[i][0]], compare_chunk, paths_to_sp3, satellite, chunk_datetime, backend)
+                bar(len(chunk_datetime))
+
+    try:
+        for recorded, (file, satellite, telescope_datetime, telescope_ra, telescope_dec, ephemeris_ra, ephemeris_dec) in enumerate(observations, 1):
+            with timings.stage("write", len(telescope_datetime), stages[file]):
+                date = write_comparison(output_dir, os.path.basename(file), satellite, offset_ms, telescope_datetime, telescope_ra, telescope_dec, ephemeris_ra, ephemeris_dec)
+                record(processed, output_dir, file, satellite, date, [offset_ms], telescope_datetime.min(), telescope_datetime.max(), available, backend)
+                manifest.checkpoint(output_dir, processed, recorded)
+            emit_file_timings(file, stages[file], None, run_stages, offset_ms=offset_ms, backend=backend)
+            #shutil.move(file, processed_telescope_data + file_name)
+    finally:
+        manifest.save(output_dir, processed)
+    emit_run_timings(run_stages, run_start, mode="chunks", files=len(observations), offset_ms=offset_ms, backend=backend, workers=workers)
+
+# Timing sweep: every offset (ms) for every observation file in one pass
+# The telescope file is read and the interpolator built once, then all offsets x samples are
+# interpolated and transformed as a single batch. Results go to the results store at <output_dir>, one offset_ms partition per offset.
+def sweep(ephemeris_folder, telescope_data_folder, output_dir, offsets, backend="astropy", force=False, dry_run=False):
+    offsets = np.asarray(offsets, dtype=int)
+    processed = manifest.load(output_dir)
+    telescope_obs_files = plan(ephemeris_folder, sorted(glob.glob(telescope_data_folder + "*.csv")), output_dir, processed, offsets, backend, force, dry_run)
+    if dry_run or not telescope_obs_files:
+        return
+
+    run_start, run_stages = time.perf_counter(), {}
+    stages = {file: {} for file, _ in telescope_obs_files}
+    telescope_obs = []
+    for file, satellite in telescope_obs_files:
+        print("Reading telescope observation file " + os.path.basename(file) + "...")
+        with timings.stage("read", record=stages[file]) as timed:
+            telescope_obs.append((file, satellite) + read_telescope_file(file))
+            timed["samples"] = len(telescope_obs[-1][2])
+    offset_range = timeutils.as_offset(offsets.min()), timeutils.as_offset(offsets.max())
+    with timings.stage("prefetch", record=run_stages):
+        available = prefetch_observations(ephemeris_type, ephemeris_folder, [(obs[2].min() + offset_range[0], obs[2].max() + offset_range[1]) for obs in telescope_obs])
+
+    try:
+        for recorded, (file, satellite, telescope_datetime, telescope_ra, telescope_dec) in enumerate(telescope_obs, 1):
+            file_name = os.path.basename(file)
+            file_start = time.perf_counter()
+            # (offsets, samples) grid of shifted timestamps, flattened into one batch
+            sweep_datetime = timeutils.apply_offset(telescope_datetime[None, :], offsets[:, None]).ravel()
+            try:
+                with timings.stage("sp3_load", record=stages[file]):
+                    paths_to_sp3 = choose_ephemerides(ephemeris_type, ephemeris_folder, sweep_datetime.min(), sweep_datetime.max(), available)
+                    interpolator = track_interpolator(paths_to_sp3, satellite)
+            except FileNotFoundError as error:
+                print(str(error) + ", skipping " + file_name)
+                continue
+            with timings.stage("interpolate", len(sweep_datetime), stages[file]):
+                x_interp, y_interp, z_interp = interpolate(interpolator, sweep_datetime)
+            print("Transforming " + str(len(offsets)) + " offsets...")
+            backend_transform_batch, obs_location = backend_transform(backend)
+            with timings.stage("transform", len(sweep_datetime), stages[file]):
+                ephemeris_ra, ephemeris_dec = backend_transform_batch(x_interp, y_interp, z_interp, sweep_datetime, obs_location)
+
+            # Partitioned on the unshifted date so every offset of a file stays under the same date
+            with timings.stage("write", len(sweep_datetime), stages[file]):
+                table = results_store.comparison_table(file_name, satellite_names[satellite], satellite, observation_date(telescope_datetime), np.repeat(offsets, len(telescope_datetime)),
+                                                       sweep_datetime, np.tile(telescope_ra, len(offsets)), np.tile(telescope_dec, len(offsets)), ephemeris_ra, ephemeris_dec)
+                results_store.clear_results(output_dir, file_name, satellite_names[satellite], observation_date(telescope_datetime), offsets)
+                results_store.write_results(table, output_dir)
+                record(processed, output_dir, file, satellite, observation_date(telescope_datetime), offsets, sweep_datetime.min(), sweep_datetime.max(), available, backend)
+                manifest.checkpoint(output_dir, processed, recorded)
+            emit_file_timings(file, stages[file], file_start, run_stages, offsets_ms=[int(offset_ms) for offset_ms in offsets], backend=backend)
+    finally:
+        manifest.save(output_dir, processed)
+    emit_run_timings(run_stages, run_start, mode="sweep", files=len(telescope_obs), offsets=len(offsets), backend=backend, workers=1)
+
+    print("Done :D Sweep saved in " + output_dir + "\n")
+
+if __name__ == "__main__":
+    offset_datetime = timedelta(milliseconds=int(0))
+    main(ephemeris_folder, telescope_data_folder, output_dir, offset = offset_datetime, workers = workers, stream = stream)
+
 
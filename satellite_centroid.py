@@ -1,37 +1,240 @@
-import matplotlib.pyplot as plt
+import argparse
+import glob
+import os
+import time
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-from astropy.stats import SigmaClip
-from astropy.io import fits
-from astropy.visualization import SqrtStretch, simple_norm
-from astropy.visualization.mpl_normalize import ImageNormalize
-from astropy.table import Table
-from astropy.nddata import NDData
-from photutils.aperture import CircularAperture
-from photutils.background import Background2D, MedianBackground
-from photutils.detection import DAOStarFinder
-from photutils.psf import extract_stars, EPSFBuilder
-
-#Load the image
-data_folder = "220502_qzs3_astrometrynet/"
-image = fits.open(data_folder + '00051021_QZS-3__MICHIBIKI-3__#42917U_20220502_1.000secs_2x2_Light.fit')
-data = image[0].data
-
-#Remove background and noise
-sigma_clip = SigmaClip(sigma=3.0, maxiters=10)
-bkg_estimator = MedianBackground()
-bkg = Background2D(data, (50,50), filter_size=(3, 3), sigma_clip=sigma_clip, bkg_estimator=bkg_estimator)
-data_nobkg = data - bkg.background #The cleaned data
-image[0].data = data_nobkg
-#image.writeto('test_nobkg.fits')
-image.close()
-
-#Get rough locations of sources
-mean, median, std = np.mean(data_nobkg), np.median(data_nobkg), np.std(data_nobkg)
-daofind = DAOStarFinder(fwhm=20.0, threshold=3.5*std)
-sources = daofind(data_nobkg)
-print(sources)
-
-#Plot image and source detections
-positions = np.transpose((sources['xcentroid'], sources['ycentroid']))
-apertures = CircularAperture(positions, r=4.)
-norm = ImageNormalize(stretch=SqrtStretch())
\ No newline at end of file
+from alive_progress import alive_bar
+# astropy, photutils and matplotlib are imported inside the functions that use them
+
+# CONFIG
+# Centroids every FITS frame in <data_folder> (background removed with Background2D, sources found with DAOStarFinder)
+# and writes one table of centroids per frame to <centroid_folder> (<frame>_centroids.ecsv, a csv with the frame name and DATE-OBS in its header)
+# Frames are spread over <workers> processes, each setting up the background estimator once and memory-mapping the frames
+# With predict = True only a cutout around the satellite's position is read and searched: the position is computed from the
+# ephemeris at mid-exposure (as in roo_vs_ephemeris) and put on the frame with its WCS (from the header or astrometry.net's
+# <frame>.wcs). Frames without a WCS or ephemeris, with the prediction off the frame or nothing found in the cutout
+# fall back to the full frame.
+
+data_folder = "220502_qzs3_astrometrynet/" # Choose the folder of FITS frames
+centroid_folder = "centroids/" # Choose where to save the centroid tables
+workers = 1 # Number of processes to spread the frames over
+predict = False # Search only a cutout around the ephemeris-predicted satellite position
+ephemeris_folder = "qzr_ephemeris/" # Choose location of QZSS ephemeris files (for predict)
+cutout_size = 256 # Side of the predicted-position cutout (pixels)
+
+box_size = (50, 50) # Background2D box size (pixels)
+filter_size = (3, 3)
+fwhm = 20.0 # DAOStarFinder FWHM (pixels)
+threshold = 3.5 # Detection threshold in standard deviations of the background-subtracted frame
+
+frame_patterns = ["*.fit", "*.fits", "*.fts"]
+centroid_columns = ["id", "xcentroid", "ycentroid", "sharpness", "roundness1", "roundness2", "peak", "flux"]
+
+####################################################################
+
+# Built once per process and reused for every frame
+@lru_cache(maxsize=None)
+def background_estimator():
+    from astropy.stats import SigmaClip
+    from photutils.background import MedianBackground
+    return SigmaClip(sigma=3.0, maxiters=10), MedianBackground()
+
+def remove_background(data):
+    from photutils.background import Background2D
+    sigma_clip, bkg_estimator = background_estimator()
+    bkg = Background2D(data, box_size, filter_size=filter_size, sigma_clip=sigma_clip, bkg_estimator=bkg_estimator)
+    return data - bkg.background
+
+# Sources in a background-subtracted image as a table of centroid_columns (no rows if nothing was found)
+# threshold is in multiples of std, the image's own std if not given
+def find_sources(data_nobkg, fwhm=fwhm, threshold=threshold, std=None):
+    from astropy.table import Table
+    from photutils.detection import DAOStarFinder
+    std = np.std(data_nobkg) if std is None else std
+    daofind = DAOStarFinder(fwhm=fwhm, threshold=threshold*std)
+    sources = daofind(data_nobkg)
+    if sources is None:
+        return Table(names=centroid_columns, dtype=[int] + [float] * (len(centroid_columns) - 1))
+    # photutils 2+ calls them x_centroid/y_centroid
+    renamed = {"xcentroid": "x_centroid", "ycentroid": "y_centroid"}
+    return Table([np.asarray(sources[name if name in sources.colnames else renamed[name]]) for name in centroid_columns], names=centroid_columns)
+
+# Header and image data of a frame (only rows/columns region = (y0, y1, x0, x1) if given), memory-mapped rather than read in full
+# Camera frames are unsigned 16 bit (BZERO = 32768), which astropy won't memory-map scaled, so the
+# raw integers are mapped and scaled here while converting to float
+def read_frame(path, region=None):
+    from astropy.io import fits
+    with fits.open(path, memmap=True, do_not_scale_image_data=True) as image:
+        header = image[0].header
+        data = image[0].data if region is None else image[0].data[region[0]:region[1], region[2]:region[3]]
+        data = data.astype(float)
+    data *= header.get("BSCALE", 1.0)
+    data += header.get("BZERO", 0.0)
+    return header, data
+
+# size x size square around (x, y), moved inside the frame; None if (x, y) is off the frame
+def cutout_region(x, y, width, height, size=cutout_size):
+    if not (0 <= x < width and 0 <= y < height):
+        return None
+    size_x, size_y = min(size, width), min(size, height)
+    x0 = int(min(max(round(x) - size_x // 2, 0), width - size_x))
+    y0 = int(min(max(round(y) - size_y // 2, 0), height - size_y))
+    return y0, y0 + size_y, x0, x0 + size_x
+
+# Sources in a frame, searched only around position (predicted (x, y) pixel) if given; meta["search"] says which was used
+def centroid_frame(path, position=None, size=cutout_size):
+    from astropy.io import fits
+    sources, header = None, None
+    if position is not None:
+        header = fits.getheader(path)
+        region = cutout_region(position[0], position[1], header["NAXIS1"], header["NAXIS2"], size)
+        if region is not None:
+            header, data = read_frame(path, region)
+            sources = find_sources(remove_background(data))
+            sources["xcentroid"] += region[2]
+            sources["ycentroid"] += region[0]
+            sources.meta["search"] = "cutout"
+    if sources is None or len(sources) == 0:
+        header, data = read_frame(path)
+        sources = find_sources(remove_background(data))
+        sources.meta["search"] = "full frame"
+    sources.meta["frame"] = os.path.basename(path)
+    sources.meta["date_obs"] = header.get("DATE-OBS")
+    if position is not None:
+        sources.meta["predicted"] = [float(position[0]), float(position[1])]
+    return sources
+
+# Celestial WCS of a frame from its header, or from the <frame>.wcs astrometry.net writes next to it (None if neither has one)
+def frame_wcs(path, header):
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    for wcs_header in [header, os.path.splitext(path)[0] + ".wcs"]:
+        if isinstance(wcs_header, str):
+            if not os.path.isfile(wcs_header):
+                continue
+            wcs_header = fits.getheader(wcs_header)
+        wcs = WCS(wcs_header).celestial
+        if wcs.has_celestial:
+            return wcs
+    return None
+
+# Mid-exposure UTC time of a frame (datetime64[ns])
+def frame_time(header):
+    exposure = header.get("EXPTIME", header.get("EXPOSURE", 0.0))
+    return np.datetime64(header["DATE-OBS"], 'ns') + np.timedelta64(int(round(exposure * 5e8)), 'ns')
+
+# Satellite of a frame from its name, e.g. 00051021_QZS-3__MICHIBIKI-3__... -> J07
+def frame_satellite(path):
+    import roo_vs_ephemeris
+    return roo_vs_ephemeris.file_satellite(os.path.basename(path).lower().replace("-", ""))
+
+# Predicted (x, y) pixel of the satellite in every frame (None where it can't be predicted)
+# The ephemeris RA/DEC of all frames of a satellite are computed in one batch
+def predict_positions(frames, ephemeris_folder=ephemeris_folder):
+    from astropy.io import fits
+    import roo_vs_ephemeris
+    positions = dict.fromkeys(frames)
+    by_satellite = {}
+    for frame in frames:
+        header = fits.getheader(frame)
+        satellite, wcs = frame_satellite(frame), frame_wcs(frame, header)
+        if satellite is None or wcs is None or "DATE-OBS" not in header:
+            continue
+        by_satellite.setdefault(satellite, []).append((frame, frame_time(header), wcs))
+    for satellite, predictable in by_satellite.items():
+        times = np.array([time for _, time, _ in predictable])
+        try:
+            paths_to_sp3 = roo_vs_ephemeris.choose_ephemerides(roo_vs_ephemeris.ephemeris_type, ephemeris_folder, times.min(), times.max())
+        except FileNotFoundError as error:
+            print(str(error) + ", searching the full frames")
+            continue
+        ephemeris_ra, ephemeris_dec = roo_vs_ephemeris.compare_chunk(paths_to_sp3, satellite, times)
+        for (frame, _, wcs), ra, dec in zip(predictable, ephemeris_ra, ephemeris_dec):
+            positions[frame] = tuple(float(pixel) for pixel in wcs.wcs_world2pix(ra, dec, 0))
+    return positions
+
+def centroid_file(path, output_folder):
+    return os.path.join(output_folder, os.path.splitext(os.path.basename(path))[0] + "_centroids.ecsv")
+
+# Centroids one frame and writes its table, returns the number of sources and where they were searched (None if the frame couldn't be read)
+def process_frame(path, output_folder, position=None, size=cutout_size):
+    try:
+        sources = centroid_frame(path, position, size)
+    except (OSError, ValueError, KeyError) as error:
+        print("Couldn't centroid " + os.path.basename(path) + ": " + str(error))
+        return None
+    sources.write(centroid_file(path, output_folder), format="ascii.ecsv", overwrite=True)
+    return len(sources), sources.meta["search"]
+
+def frame_files(data_folder):
+    return sorted(path for pattern in frame_patterns for path in glob.glob(os.path.join(data_folder, pattern)))
+
+def batch(data_folder, output_folder, workers=1, predict=False, ephemeris_folder=ephemeris_folder, size=cutout_size):
+    frames = frame_files(data_folder)
+    os.makedirs(output_folder, exist_ok=True)
+    start = time.perf_counter()
+    positions = [None] * len(frames)
+    if predict:
+        print("Predicting the satellite position in " + str(len(frames)) + " frames...")
+        predicted = predict_positions(frames, ephemeris_folder)
+        positions = [predicted[frame] for frame in frames]
+    print("Centroiding " + str(len(frames)) + " frames...")
+    results = []
+    with alive_bar(len(frames)) as bar:
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                for result in pool.map(process_frame, frames, [output_folder] * len(frames), positions, [size] * len(frames), chunksize=4):
+                    results.append(result)
+                    bar()
+        else:
+            for frame, position in zip(frames, positions):
+                results.append(process_frame(frame, output_folder, position, size))
+                bar()
+    elapsed = time.perf_counter() - start
+    done = [result for result in results if result is not None]
+    print("Done :D " + str(len(done)) + " frames (" + str(sum(count for count, _ in done)) + " sources) in " + format(elapsed, ".1f") + "s, "
+          + format(len(done) / elapsed if elapsed > 0 else 0, ".2f") + " frames/s. Centroids saved in " + output_folder)
+    if predict:
+        print(str(sum(search == "cutout" for _, search in done)) + " frames searched around the predicted position, the rest full frame")
+    return results
+
+# Plot a frame with its source detections
+def plot_sources(path):
+    import matplotlib.pyplot as plt
+    from astropy.visualization import SqrtStretch
+    from astropy.visualization.mpl_normalize import ImageNormalize
+    from photutils.aperture import CircularAperture
+    header, data = read_frame(path)
+    data_nobkg = remove_background(data)
+    sources = find_sources(data_nobkg)
+    print(sources)
+    positions = np.transpose((sources['xcentroid'], sources['ycentroid']))
+    apertures = CircularAperture(positions, r=4.)
+    norm = ImageNormalize(stretch=SqrtStretch())
+    plt.imshow(data_nobkg, cmap='Greys', origin='lower', norm=norm)
+    apertures.plot(color='blue', lw=1.5, alpha=0.5)
+    plt.show()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="roo-centroid", description="Centroid the sources in a folder of FITS frames.")
+    parser.add_argument("data_folder", nargs="?", default=data_folder, help="folder of FITS frames (default: %(default)s)")
+    parser.add_argument("--output-dir", default=centroid_folder, help="where to save the centroid tables (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=workers, help="number of worker processes (default: %(default)s)")
+    parser.add_argument("--predict", action="store_true", default=predict, help="only search a cutout around the satellite position predicted from the ephemeris and the frame's WCS")
+    parser.add_argument("--ephemeris-folder", default=ephemeris_folder, help="where SP3 files are kept/downloaded to, for --predict (default: %(default)s)")
+    parser.add_argument("--cutout-size", type=int, default=cutout_size, help="side of the --predict cutout in pixels (default: %(default)s)")
+    parser.add_argument("--plot", metavar="FRAME", help="plot the detections in one frame instead")
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.cutout_size < 2 * max(box_size):
+        parser.error("--cutout-size must be at least " + str(2 * max(box_size)) + " (two background boxes)")
+    if args.plot:
+        plot_sources(args.plot)
+    else:
+        batch(args.data_folder, args.output_dir, args.workers, args.predict, args.ephemeris_folder, args.cutout_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import os
+from functools import lru_cache
+from pathlib import Path
+import numpy as np
+import fileutils
+import sp3_reader
+
+# Parsed-SP3 cache
+# Each satellite's track is parsed out of an SP3 file once and saved under <cache_folder>/<sha256 of the file>/<sv>.npy
+# as a float64 (epochs, 4) array of [GPS seconds since gps_epoch, ITRS x, y, z (km)], which np.load can memory-map.
+# Repeat runs (and repeat calls within a run, through the in-process LRU) skip SP3 text parsing entirely.
+
+cache_folder = "sp3_cache/" # Choose where to keep the parsed ephemerides
+lru_size = 64 # Number of satellite tracks kept in memory
+
+gps_epoch = np.datetime64("1980-01-06T00:00:00", "ns")
+
+def file_digest(path_to_sp3):
+    stat = os.stat(path_to_sp3)
+    return _file_digest(os.path.abspath(path_to_sp3), stat.st_mtime_ns, stat.st_size)
+
+# Hashing is memoised on (path, mtime, size) so a file is only read again once it changes
+@lru_cache(maxsize=256)
+def _file_digest(path_to_sp3, mtime_ns, size):
+    return fileutils.sha256(path_to_sp3)
+
+# Valid positions of the requested satellites (all of them if None) from an SP3 file
+def parse_sp3(path_to_sp3, satellites=None):
+    satellites, epochs, positions, clock = sp3_reader.read_sp3(path_to_sp3, satellites)
+    epoch_seconds = (epochs - gps_epoch) / np.timedelta64(1, "s")
+    tracks = {}
+    for i, satellite in enumerate(satellites):
+        valid = np.all(np.isfinite(positions[:, i]), axis=1)
+        tracks[satellite] = np.column_stack((epoch_seconds[valid], positions[valid, i]))
+    return tracks
+
+def write_cache(digest, tracks):
+    cache_dir = Path(cache_folder) / digest
+    for satellite, track in tracks.items():
+        # Written atomically, so an interrupted run never leaves a partial entry
+        fileutils.atomic_write(cache_dir / (satellite + ".npy"), lambda tmp_path: np.save(tmp_path, np.ascontiguousarray(track, dtype=np.float64)), ".npy")
+    return cache_dir
+
+@lru_cache(maxsize=lru_size)
+def _load_track(digest, path_to_sp3, satellite):
+    track_path = Path(cache_folder) / digest / (satellite + ".npy")
+    if not track_path.is_file():
+        print("Parsing " + os.path.basename(path_to_sp3) + " into the SP3 cache...")
+        write_cache(digest, parse_sp3(path_to_sp3, [satellite]))
+    return np.load(track_path, mmap_mode="r")
+
+# Satellite track as (GPS epochs as datetime64[ns], ITRS positions (epochs, 3) in km)
+def load_ephemeris(path_to_sp3, satellite):
+    track = load_track(path_to_sp3, satellite)
+    satellite_time_gps = gps_epoch + np.round(track[:, 0] * 1e9).astype("timedelta64[ns]")
+    return satellite_time_gps, track[:, 1:]
+
+# Raw cached (epochs, 4) array, memory-mapped from the cache
+def load_track(path_to_sp3, satellite):
+    return _load_track(file_digest(path_to_sp3), str(path_to_sp3), satellite)
@@ -0,0 +1,149 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import ephemeris_source
+import fileutils
+import sp3_reader
+# requests is imported inside the functions that use it
+
+# SP3 prefetcher
+# Every SP3 file a run needs is worked out up front and fetched before processing starts, concurrently over one
+# pooled HTTP session, instead of downloading one file at a time in the middle of the run.
+# Each file is looked for in <ephemeris_folder>, then in the local mirror (if set), then downloaded. If a final
+# product isn't available the rapid one for the same day is used instead.
+# Downloads are written to a temporary file and only renamed into place once they pass validation:
+# HTTP status, Content-Length, an SP3 header and the closing EOF line (and the sha256 from a <file>.sha256 next to it
+# in the mirror, if there is one). Truncated or error-page downloads are never left in <ephemeris_folder>.
+
+base_urls = {
+    "final": "https://sys.qzss.go.jp/archives/final-sp3/",
+    "rapid": "https://sys.qzss.go.jp/archives/rapid-sp3/",
+}
+mirror_folder = None # Local folder with SP3 files (flat, or in <year>/ sub-folders like the archive) to use before downloading
+connections = 4 # Concurrent downloads
+timeout = 60 # Seconds per request
+retries = 3
+
+fallback = {"final": "rapid"}
+
+# SP3 version header on the first line and the EOF line at the end
+def valid_sp3(path_to_sp3):
+    try:
+        with sp3_reader.open_sp3(path_to_sp3) as sp3_file:
+            header = sp3_file.readline()
+            last = header
+            for line in sp3_file:
+                if line.strip():
+                    last = line
+    except (OSError, ValueError, RuntimeError, EOFError):
+        return False
+    return header[:1] == "#" and header[1:2] in ("a", "b", "c", "d") and last.strip() == "EOF"
+
+def session(pool_size=connections):
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    http = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=Retry(total=retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]))
+    http.mount("http://", adapter)
+    http.mount("https://", adapter)
+    return http
+
+def gps_day_year(gps_week, gps_day):
+    return str((ephemeris_source.gps_epoch + (gps_week * 7 + gps_day) * ephemeris_source.day).astype('datetime64[Y]'))
+
+# Whether a finished temporary file is a complete SP3 file (it's deleted rather than moved into place if not)
+def complete(tmp_path, file_name):
+    if not valid_sp3(tmp_path):
+        print(file_name + " isn't a complete SP3 file, discarded")
+        return False
+    return True
+
+def from_mirror(file_name, year, ephemeris_folder, mirror):
+    for mirror_path in [Path(mirror) / year / file_name, Path(mirror) / file_name]:
+        if mirror_path.is_file():
+            checksum_path = Path(str(mirror_path) + ".sha256")
+            if checksum_path.is_file() and checksum_path.read_text().split()[0].lower() != fileutils.sha256(mirror_path):
+                print(file_name + " in the mirror doesn't match its checksum, skipping")
+                continue
+
+            def copy(tmp_path):
+                shutil.copyfile(mirror_path, tmp_path)
+                return complete(tmp_path, file_name)
+            print("Using " + file_name + " from the mirror")
+            file_path = Path(ephemeris_folder) / file_name
+            return file_path if fileutils.atomic_write(file_path, copy, ".sp3") else None
+    return None
+
+def download(http, url, ephemeris_folder, file_name):
+    import requests
+
+    def fetch(tmp_path):
+        with open(tmp_path, "wb") as tmp_file, http.get(url, stream=True, timeout=timeout) as response:
+            if response.status_code != 200:
+                print(file_name + " isn't available (" + str(response.status_code) + ")")
+                return False
+            size = 0
+            for block in response.iter_content(1 << 16):
+                tmp_file.write(block)
+                size += len(block)
+            # Content-Length is the encoded size if the server compressed the response, only compare it otherwise
+            expected = response.headers.get("Content-Length")
+            if expected is not None and "Content-Encoding" not in response.headers and int(expected) != size:
+                print(file_name + " download was cut short (" + str(size) + " of " + expected + " bytes)")
+                return False
+        return complete(tmp_path, file_name)
+
+    file_path = Path(ephemeris_folder) / file_name
+    try:
+        if not fileutils.atomic_write(file_path, fetch, ".sp3"):
+            return None
+    except requests.RequestException as error:
+        print("Couldn't download " + file_name + ": " + str(error))
+        return None
+    print("Downloaded " + file_name)
+    return file_path
+
+# Path of the SP3 file for a GPS week/day, from <ephemeris_folder>, the mirror or the archive (None if there isn't one)
+def resolve(ephemeris_type, gps_week, gps_day, ephemeris_folder, http=None, mirror=None, urls=None):
+    mirror = mirror_folder if mirror is None else mirror
+    urls = base_urls if urls is None else urls
+    year = gps_day_year(gps_week, gps_day)
+    for product in [ephemeris_type] + ([fallback[ephemeris_type]] if ephemeris_type in fallback else []):
+        file_name = ephemeris_source.sp3_file_name(product, gps_week, gps_day)
+        file_path = Path(ephemeris_folder) / file_name
+        if file_path.is_file():
+            return file_path
+        path = from_mirror(file_name, year, ephemeris_folder, mirror) if mirror is not None else None
+        if path is None and http is not None:
+            path = download(http, urls[product] + year + "/" + file_name, ephemeris_folder, file_name)
+        if path is not None:
+            if product != ephemeris_type:
+                print("Using " + product + " ephemeris " + file_name + " instead")
+            return path
+    return None
+
+# Fetches every (week, day) in days at once; returns {(week, day): path or None}
+# With offline=True only <ephemeris_folder> and the mirror are used
+def prefetch(days, ephemeris_type, ephemeris_folder, mirror=None, urls=None, offline=False):
+    os.makedirs(ephemeris_folder, exist_ok=True)
+    days = sorted(set(days))
+    http = None if offline else session(min(connections, max(len(days), 1)))
+    try:
+        with ThreadPoolExecutor(max_workers=connections) as pool:
+            paths = pool.map(lambda week_day: resolve(ephemeris_type, week_day[0], week_day[1], ephemeris_folder, http, mirror, urls), days)
+            return dict(zip(days, paths))
+    finally:
+        if http is not None:
+            http.close()
+
+# GPS days needed for observations spanning [start, end] (UTC datetime64), split into the days the observations
+# fall on (required) and the ones only needed for the interpolation margin
+def observation_days(ranges):
+    required, margin = set(), set()
+    for start, end in ranges:
+        required.update(ephemeris_source.days_needed(start, end, margin=np.timedelta64(0, 's')))
+        margin.update(ephemeris_source.days_needed(start, end))
+    return required, margin - required
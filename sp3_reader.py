@@ -0,0 +1,95 @@
+import gzip
+import io
+import numpy as np
+
+# Streaming SP3-c/d reader
+# Only the position ('P') records of the requested satellites are parsed, straight into preallocated arrays.
+# Bad/missing values are returned as NaN: positions written as 0.000000 and clocks of 999999.999999 (or more).
+# Unix-compressed (.Z) and gzipped (.gz) files are recognised by their magic bytes and read directly.
+
+bad_clock = 999999.0
+
+def open_sp3(path_to_sp3):
+    with open(path_to_sp3, "rb") as sp3_file:
+        magic = sp3_file.read(2)
+    if magic == b"\x1f\x9d":
+        from ncompress import decompress # Only needed for .Z files
+        with open(path_to_sp3, "rb") as sp3_file:
+            return io.StringIO(decompress(sp3_file.read()).decode("ascii"))
+    if magic == b"\x1f\x8b":
+        return gzip.open(path_to_sp3, "rt", encoding="ascii")
+    return open(path_to_sp3, "r", encoding="ascii")
+
+def sv_name(field):
+    # Older files leave out the constellation letter for GPS satellites
+    if field[0] == " ":
+        field = "G" + field[1:]
+    return field.replace(" ", "0")
+
+def parse_epoch(line):
+    year, month, day, hour, minute = (int(field) for field in line[3:19].split())
+    seconds = float(line[20:31])
+    return np.datetime64("{:04d}-{:02d}-{:02d}T{:02d}:{:02d}".format(year, month, day, hour, minute), "ns") + np.timedelta64(round(seconds * 1e9), "ns")
+
+# Returns (satellites, epochs, positions, clock):
+# satellites - list of SV names, in the order of the last two arrays' satellite axis
+# epochs - GPS time of each epoch, datetime64[ns], shape (epochs,)
+# positions - ITRS x/y/z in km, shape (epochs, satellites, 3)
+# clock - clock correction in microseconds, shape (epochs, satellites)
+def read_sp3(path_to_sp3, satellites=None):
+    with open_sp3(path_to_sp3) as sp3_file:
+        first_line = sp3_file.readline()
+        if not first_line.startswith("#") or first_line[1] not in "cd":
+            raise ValueError(str(path_to_sp3) + " is not an SP3-c/d file")
+        no_epochs = int(first_line[32:39])
+
+        # Header satellite list ('+ ' lines, 17 three-character IDs per line after the count)
+        header_svs = []
+        no_svs = None
+        line = sp3_file.readline()
+        while line and not line.startswith("*"):
+            if line.startswith("+ "):
+                if no_svs is None:
+                    no_svs = int(line[3:6])
+                header_svs += [sv_name(line[i:i+3]) for i in range(9, 60, 3)]
+            line = sp3_file.readline()
+        header_svs = header_svs[:no_svs]
+
+        if satellites is None:
+            satellites = header_svs
+        else:
+            satellites = list(satellites)
+            missing = [satellite for satellite in satellites if satellite not in header_svs]
+            if missing:
+                raise KeyError(", ".join(missing) + " not in " + str(path_to_sp3))
+        sv_index = {satellite: i for i, satellite in enumerate(satellites)}
+
+        epochs = np.empty(no_epochs, dtype="datetime64[ns]")
+        positions = np.full((no_epochs, len(satellites), 3), np.nan)
+        clock = np.full((no_epochs, len(satellites)), np.nan)
+
+        epoch = -1
+        while line:
+            if line[0] == "*":
+                epoch += 1
+                if epoch == len(epochs): # More epochs than the header promised
+                    extra = max(len(epochs), 96)
+                    epochs = np.concatenate((epochs, np.empty(extra, dtype="datetime64[ns]")))
+                    positions = np.concatenate((positions, np.full((extra,) + positions.shape[1:], np.nan)))
+                    clock = np.concatenate((clock, np.full((extra,) + clock.shape[1:], np.nan)))
+                epochs[epoch] = parse_epoch(line)
+            elif line[0] == "P":
+                i = sv_index.get(sv_name(line[1:4]))
+                if i is not None:
+                    xyz = (float(line[4:18]), float(line[18:32]), float(line[32:46]))
+                    if xyz != (0.0, 0.0, 0.0):
+                        positions[epoch, i] = xyz
+                    clock_field = line[46:60].strip()
+                    if clock_field and float(clock_field) < bad_clock:
+                        clock[epoch, i] = float(clock_field)
+            elif line.startswith("EOF"):
+                break
+            line = sp3_file.readline()
+
+    no_epochs = epoch + 1
+    return satellites, epochs[:no_epochs], positions[:no_epochs], clock[:no_epochs]
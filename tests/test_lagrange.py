@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+import lagrange
+from lagrange import LagrangeInterpolator
+
+# LagrangeInterpolator against the textbook formula, polynomials it must reproduce and finite differences
+
+rng = np.random.default_rng(2199)
+# An SP3-like track: 15 minute epochs with some jitter, positions in km
+epochs = np.arange(40) * 900.0 + rng.uniform(-30, 30, 40)
+positions = rng.normal(0, 20000, (40, 3))
+# Between nodes, on nodes and at both ends of the track
+queries = np.concatenate((rng.uniform(epochs[0], epochs[-1], 200), epochs[[0, 1, 17, -2, -1]]))
+
+# sum_j y_j prod_{m != j} (t - t_m)/(t_j - t_m) over the same window of nodes, one query at a time
+def direct(interpolator, t):
+    start = interpolator.window_start(np.array([t]))[0]
+    nodes = interpolator.t[start:start + interpolator.order]
+    values = interpolator.positions[start:start + interpolator.order]
+    result = np.zeros(values.shape[1])
+    for j in range(len(nodes)):
+        basis = 1.0
+        for m in range(len(nodes)):
+            if m != j:
+                basis *= (t - nodes[m]) / (nodes[j] - nodes[m])
+        result += basis * values[j]
+    return result
+
+def test_matches_direct_formula():
+    interpolator = LagrangeInterpolator(epochs, positions)
+    expected = np.array([direct(interpolator, t - epochs[0]) for t in queries])
+    np.testing.assert_allclose(interpolator(queries), expected, rtol=1e-9, atol=1e-6)
+
+def test_nodes_are_returned_exactly():
+    np.testing.assert_allclose(LagrangeInterpolator(epochs, positions)(epochs), positions, rtol=1e-12, atol=1e-9)
+
+# Order 9 reproduces any polynomial of degree 8, and its derivative, whichever window is used
+def test_reproduces_polynomials():
+    coefficients = rng.normal(0, 1, (9, 3)) / 3600.0 ** np.arange(9)[:, None]
+    values = np.polynomial.polynomial.polyval(epochs - epochs[0], coefficients).T
+    derivative = np.polynomial.polynomial.polyval(queries - epochs[0], np.polynomial.polynomial.polyder(coefficients)).T
+    position, velocity = LagrangeInterpolator(epochs, values)(queries, velocity=True)
+    np.testing.assert_allclose(position, np.polynomial.polynomial.polyval(queries - epochs[0], coefficients).T, rtol=1e-9, atol=1e-9)
+    np.testing.assert_allclose(velocity, derivative, rtol=1e-7, atol=1e-9)
+
+def test_velocity_matches_finite_difference():
+    interpolator = LagrangeInterpolator(epochs, positions)
+    position, velocity = interpolator(queries, velocity=True)
+    step = 1e-3
+    finite_difference = (interpolator(queries + step) - interpolator(queries - step)) / (2 * step)
+    np.testing.assert_allclose(position, interpolator(queries))
+    # Queries within step of a window change are left out, the interpolant switches polynomials there
+    same_window = interpolator.window_start(queries - step - epochs[0]) == interpolator.window_start(queries + step - epochs[0])
+    np.testing.assert_allclose(velocity[same_window], finite_difference[same_window], rtol=1e-5, atol=1e-5)
+
+def test_datetime_epochs_match_seconds():
+    start = np.datetime64("2022-03-02T00:00:00", "ns")
+    datetime_epochs = start + (epochs * 1e9).astype('timedelta64[ns]')
+    datetime_queries = start + (queries * 1e9).astype('timedelta64[ns]')
+    np.testing.assert_allclose(LagrangeInterpolator(datetime_epochs, positions)(datetime_queries), LagrangeInterpolator(epochs, positions)(queries), rtol=1e-9, atol=1e-6)
+
+def test_chunks_match_one_batch(monkeypatch):
+    expected = LagrangeInterpolator(epochs, positions)(queries, velocity=True)
+    monkeypatch.setattr(lagrange, "chunk_size", 7)
+    for result, reference in zip(LagrangeInterpolator(epochs, positions)(queries, velocity=True), expected):
+        np.testing.assert_array_equal(result, reference)
+
+def test_unsorted_epochs_are_rejected():
+    with pytest.raises(ValueError):
+        LagrangeInterpolator(epochs[::-1], positions)
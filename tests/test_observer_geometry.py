@@ -0,0 +1,39 @@
+from pathlib import Path
+import numpy as np
+import pytest
+import observer_geometry
+import roo_vs_ephemeris
+import sp3_cache
+import timeutils
+
+# The precomputed backend against astropy's full ITRS -> GCRS transform, on a day of QZS-3 orbit
+
+sp3 = str(Path(__file__).parent.parent / "qzr_ephemeris" / "qzf21993.sp3")
+
+@pytest.fixture(autouse=True)
+def caches(tmp_path, monkeypatch):
+    monkeypatch.setattr(sp3_cache, "cache_folder", str(tmp_path / "sp3_cache") + "/")
+    monkeypatch.setattr(observer_geometry, "cache_folder", str(tmp_path / "observer_cache") + "/")
+    observer_geometry.load_table.cache_clear()
+    yield
+    observer_geometry.load_table.cache_clear()
+
+# Angular separation (arcsec) between two sets of RA/DEC (degrees), haversine so it stays precise at micro-arcseconds
+def separation(ra, dec, other_ra, other_dec):
+    ra, dec, other_ra, other_dec = np.radians(ra), np.radians(dec), np.radians(other_ra), np.radians(other_dec)
+    haversine = np.sin((dec - other_dec) / 2)**2 + np.cos(dec) * np.cos(other_dec) * np.sin((ra - other_ra) / 2)**2
+    return np.degrees(2 * np.arcsin(np.sqrt(haversine))) * 3600
+
+@pytest.mark.filterwarnings("ignore") # IERS data older than the SP3 file, the same for both
+def test_matches_astropy():
+    satellite_time_gps, satellite_itrs = sp3_cache.load_ephemeris(sp3, roo_vs_ephemeris.QZS3)
+    start, end = timeutils.gps_to_utc(satellite_time_gps[[4, -5]])
+    # Off the SP3 epochs and spanning two observing nights
+    telescope_datetime = start + ((end - start) * np.linspace(0, 1, 2000)).astype('timedelta64[ns]') + np.timedelta64(123456, 'us')
+    assert len(np.unique(timeutils.observing_night(telescope_datetime, roo_vs_ephemeris.roo[1]))) == 2
+    x, y, z = roo_vs_ephemeris.interpolate(roo_vs_ephemeris.track_interpolator(sp3, roo_vs_ephemeris.QZS3), telescope_datetime)
+    obs_location = roo_vs_ephemeris.get_obs_location()
+
+    ra, dec = roo_vs_ephemeris.transform_batch(x, y, z, telescope_datetime, obs_location)
+    precomputed_ra, precomputed_dec = observer_geometry.transform_batch(x, y, z, telescope_datetime, obs_location)
+    assert separation(ra, dec, precomputed_ra, precomputed_dec).max() < 3e-5
@@ -0,0 +1,30 @@
+from pathlib import Path
+import numpy as np
+import pytest
+import roo_vs_ephemeris
+import sp3_cache
+import timeutils
+
+# The batched astropy transform against the original one-sample-at-a-time transform()
+
+sp3 = str(Path(__file__).parent.parent / "qzr_ephemeris" / "qzf21993.sp3")
+
+@pytest.fixture(autouse=True)
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(sp3_cache, "cache_folder", str(tmp_path / "sp3_cache") + "/")
+
+@pytest.mark.filterwarnings("ignore") # IERS data older than the SP3 file, the same for both
+def test_transform_batch_matches_transform():
+    satellite_time_gps, satellite_itrs = sp3_cache.load_ephemeris(sp3, roo_vs_ephemeris.QZS3)
+    start, end = timeutils.gps_to_utc(satellite_time_gps[[4, -5]])
+    telescope_datetime = start + ((end - start) * np.linspace(0, 1, 12)).astype('timedelta64[ns]') + np.timedelta64(123456, 'us')
+    x, y, z = roo_vs_ephemeris.interpolate(roo_vs_ephemeris.track_interpolator(sp3, roo_vs_ephemeris.QZS3), telescope_datetime)
+    obs_location = roo_vs_ephemeris.get_obs_location()
+
+    ra, dec = roo_vs_ephemeris.transform_batch(x, y, z, telescope_datetime, obs_location)
+    reference = np.array([roo_vs_ephemeris.transform(x[i], y[i], z[i], telescope_datetime[i], obs_location) for i in range(len(telescope_datetime))])
+    # Residuals in arcsec, RA scaled by cos(dec) as in the comparison results
+    ra_residual = ((ra - reference[:, 0] + 180) % 360 - 180) * np.cos(np.radians(dec)) * 3600
+    dec_residual = (dec - reference[:, 1]) * 3600
+    assert np.abs(ra_residual).max() < 1e-3
+    assert np.abs(dec_residual).max() < 1e-3
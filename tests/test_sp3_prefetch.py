@@ -0,0 +1,117 @@
+import hashlib
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import ephemeris_source
+import sp3_prefetch
+
+# sp3_prefetch against a local HTTP stand-in for the QZSS archive, no network needed
+
+week, day = 2199, 3
+year = sp3_prefetch.gps_day_year(week, day)
+final_name = ephemeris_source.sp3_file_name("final", week, day)
+rapid_name = ephemeris_source.sp3_file_name("rapid", week, day)
+
+sp3_body = b"#cP2022  3  2  0  0  0.00000000      96 ORBIT   JGS FIT  QSS\n## 2199 259200.00000000   900.00000000 59640 0.0000000000000\n*  2022  3  2  0  0  0.00000000\nEOF\n"
+html_body = b"<html><body><h1>Service unavailable</h1></body></html>\n"
+
+# {path: (status, body, Content-Length or None for the body's length)}
+routes = {}
+requested = []
+
+class Archive(BaseHTTPRequestHandler):
+    def do_GET(self):
+        requested.append(self.path)
+        status, body, length = routes.get(self.path, (404, b"Not found", None))
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body) if length is None else length))
+        self.end_headers()
+        self.wfile.write(body)
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture(scope="module")
+def urls():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Archive)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = "http://127.0.0.1:" + str(server.server_address[1])
+    yield {"final": base + "/final/", "rapid": base + "/rapid/"}
+    server.shutdown()
+
+@pytest.fixture(autouse=True)
+def clear_routes():
+    routes.clear()
+    requested.clear()
+    yield
+    routes.clear()
+
+def serve(product, file_name, body, status=200, length=None):
+    routes["/" + product + "/" + year + "/" + file_name] = (status, body, length)
+
+def fetch(tmp_path, urls, mirror=None, offline=False):
+    folder = tmp_path / "ephemeris"
+    return sp3_prefetch.prefetch([(week, day)], "final", str(folder), mirror=mirror, urls=urls, offline=offline)[(week, day)], folder
+
+# Nothing but the finished SP3 files (no .tmp_ leftovers)
+def leftovers(folder):
+    return sorted(name for name in os.listdir(folder) if name.startswith(".tmp_"))
+
+def test_download(tmp_path, urls):
+    serve("final", final_name, sp3_body)
+    path, folder = fetch(tmp_path, urls)
+    assert path.name == final_name
+    assert path.read_bytes() == sp3_body
+    assert leftovers(folder) == []
+
+def test_missing_final_falls_back_to_rapid(tmp_path, urls):
+    serve("rapid", rapid_name, sp3_body)
+    path, folder = fetch(tmp_path, urls)
+    assert path.name == rapid_name
+    assert not (folder / final_name).exists()
+
+def test_missing_download_falls_back_to_mirror(tmp_path, urls):
+    mirror = tmp_path / "mirror" / year
+    mirror.mkdir(parents=True)
+    (mirror / rapid_name).write_bytes(sp3_body)
+    path, folder = fetch(tmp_path, urls, mirror=str(tmp_path / "mirror"))
+    assert path.name == rapid_name
+    assert path.read_bytes() == sp3_body
+
+def test_html_error_page_is_discarded(tmp_path, urls):
+    serve("final", final_name, html_body)
+    serve("rapid", rapid_name, html_body)
+    path, folder = fetch(tmp_path, urls)
+    assert path is None
+    assert os.listdir(folder) == []
+
+def test_short_read_is_discarded(tmp_path, urls):
+    serve("final", final_name, sp3_body[:40], length=len(sp3_body))
+    path, folder = fetch(tmp_path, urls)
+    assert path is None
+    assert os.listdir(folder) == []
+
+def test_mirror_checksum_mismatch_downloads_instead(tmp_path, urls):
+    mirror = tmp_path / "mirror"
+    mirror.mkdir()
+    corrupt = sp3_body.replace(b"2022", b"2023")
+    (mirror / final_name).write_bytes(corrupt)
+    (mirror / (final_name + ".sha256")).write_text(hashlib.sha256(sp3_body).hexdigest() + "  " + final_name + "\n")
+    serve("final", final_name, sp3_body)
+    path, folder = fetch(tmp_path, urls, mirror=str(mirror))
+    assert path.read_bytes() == sp3_body
+    assert leftovers(folder) == []
+
+def test_offline_uses_the_mirror_only(tmp_path, urls):
+    serve("final", final_name, sp3_body)
+    path, folder = fetch(tmp_path, urls, offline=True)
+    assert path is None
+    assert requested == []
+    mirror = tmp_path / "mirror"
+    mirror.mkdir()
+    (mirror / final_name).write_bytes(sp3_body)
+    path, folder = fetch(tmp_path, urls, mirror=str(mirror), offline=True)
+    assert path.name == final_name
@@ -0,0 +1,47 @@
+import erfa
+import numpy as np
+import pytest
+import timeutils
+
+# The bundled leap second table against ERFA's, and the UTC/GPS/TAI/TT conversions built on it
+
+day = np.timedelta64(1, 'D')
+
+# TAI - UTC (s) from erfa.dat at 00:00 UTC on a date
+def erfa_tai_utc(date):
+    year, month, day_of_month = (int(part) for part in str(date).split("-"))
+    return erfa.dat(year, month, day_of_month, 0.0)
+
+@pytest.mark.parametrize("date, offset", timeutils.leap_seconds)
+def test_leap_seconds_match_erfa(date, offset):
+    step = np.datetime64(date, 'ns')
+    assert erfa_tai_utc(date) == offset
+    assert timeutils.tai_utc(step) == np.timedelta64(offset, 's')
+    if date == timeutils.leap_seconds[0][0]:
+        with pytest.raises(ValueError):
+            timeutils.tai_utc(step - np.timedelta64(1, 'ns'))
+    else:
+        assert erfa_tai_utc(np.datetime64(date, 'D') - day) == offset - 1
+        assert timeutils.tai_utc(step - np.timedelta64(1, 'ns')) == np.timedelta64(offset - 1, 's')
+
+# No leap second in ERFA's table since 1972 is missing from ours
+def test_no_leap_second_missing():
+    dates = [str(np.datetime64("%04d-%02d-01" % (year, month))) for year, month, _ in erfa.leap_seconds.get() if year >= 1972]
+    assert dates == [date for date, _ in timeutils.leap_seconds]
+
+def test_gps_utc_offsets():
+    assert timeutils.utc_to_gps(np.datetime64("1980-01-06T00:00:00", 'ns')) == np.datetime64("1980-01-06T00:00:00", 'ns')
+    assert timeutils.gps_to_utc(np.datetime64("2022-03-02T00:00:18", 'ns')) == np.datetime64("2022-03-02T00:00:00", 'ns')
+    assert timeutils.utc_to_tt(np.datetime64("2022-03-02T00:00:00", 'ns')) == np.datetime64("2022-03-02T00:01:09.184", 'ns')
+
+def test_round_trip():
+    rng = np.random.default_rng(37)
+    start, end = timeutils.to_ns(np.datetime64("1980-01-06", 'ns')), timeutils.to_ns(np.datetime64("2030-01-01", 'ns'))
+    utc = timeutils.from_ns(rng.integers(start, end, 100000))
+    # Either side of every leap second, to the nanosecond
+    steps = timeutils.leap_utc[timeutils.leap_utc >= np.datetime64("1980-01-06")]
+    utc = np.concatenate((utc, steps, steps - np.timedelta64(1, 'ns'), steps + np.timedelta64(1, 'ns')))
+    np.testing.assert_array_equal(timeutils.gps_to_utc(timeutils.utc_to_gps(utc)), utc)
+    # (GPS times inside an inserted leap second have no UTC of their own, so the GPS side starts from UTC times)
+    gps = timeutils.utc_to_gps(utc)
+    np.testing.assert_array_equal(timeutils.utc_to_gps(timeutils.gps_to_utc(gps)), gps)
@@ -0,0 +1,108 @@
+import numpy as np
+from datetime import datetime, timedelta
+
+# Time handling shared by the pipeline
+# Timestamps are kept as datetime64[ns] arrays (int64 nanoseconds since 1970-01-01), so parsing, offsets and
+# GPS/UTC/TAI/TT conversion are each a single array operation rather than a python loop over datetimes.
+
+# TAI - UTC (s) from each date (00:00 UTC) onwards, from IERS Bulletin C. Bundled so no download is needed;
+# add a row whenever a new leap second is announced.
+leap_seconds = [
+    ("1972-01-01", 10), ("1972-07-01", 11), ("1973-01-01", 12), ("1974-01-01", 13), ("1975-01-01", 14),
+    ("1976-01-01", 15), ("1977-01-01", 16), ("1978-01-01", 17), ("1979-01-01", 18), ("1980-01-01", 19),
+    ("1981-07-01", 20), ("1982-07-01", 21), ("1983-07-01", 22), ("1985-07-01", 23), ("1988-01-01", 24),
+    ("1990-01-01", 25), ("1991-01-01", 26), ("1992-07-01", 27), ("1993-07-01", 28), ("1994-07-01", 29),
+    ("1996-01-01", 30), ("1997-07-01", 31), ("1999-01-01", 32), ("2006-01-01", 33), ("2009-01-01", 34),
+    ("2012-07-01", 35), ("2015-07-01", 36), ("2017-01-01", 37),
+]
+
+tai_gps_offset = np.timedelta64(19, 's') # TAI - GPS, fixed
+tt_tai_offset = np.timedelta64(32184, 'ms') # TT - TAI, fixed
+
+leap_utc = np.array([date for date, _ in leap_seconds], dtype='datetime64[ns]')
+leap_offset = np.array([offset for _, offset in leap_seconds]).astype('timedelta64[s]').astype('timedelta64[ns]')
+leap_tai = leap_utc + leap_offset # The same steps on the TAI time line
+
+# TAI - UTC for every time in an array, looked up in the table on either the UTC or the TAI time line
+def tai_utc(times, scale='utc'):
+    times = np.asarray(times, dtype='datetime64[ns]')
+    i = np.searchsorted(leap_utc if scale == 'utc' else leap_tai, times, side='right') - 1
+    if np.any(i < 0):
+        raise ValueError("Times before 1972-01-01 are not covered by the leap second table")
+    return leap_offset[i]
+
+def utc_to_tai(times):
+    return np.asarray(times, dtype='datetime64[ns]') + tai_utc(times, 'utc')
+
+def tai_to_utc(times):
+    return np.asarray(times, dtype='datetime64[ns]') - tai_utc(times, 'tai')
+
+def gps_to_tai(times):
+    return np.asarray(times, dtype='datetime64[ns]') + tai_gps_offset
+
+def tai_to_gps(times):
+    return np.asarray(times, dtype='datetime64[ns]') - tai_gps_offset
+
+def tai_to_tt(times):
+    return np.asarray(times, dtype='datetime64[ns]') + tt_tai_offset
+
+def utc_to_gps(times):
+    return tai_to_gps(utc_to_tai(times))
+
+def gps_to_utc(times):
+    return tai_to_utc(gps_to_tai(times))
+
+def utc_to_tt(times):
+    return tai_to_tt(utc_to_tai(times))
+
+def gps_to_tt(times):
+    return tai_to_tt(gps_to_tai(times))
+
+# Julian date of datetime64 times (in whatever scale they are in) as whole + fraction, to keep ns precision
+def julian_date(times):
+    ns = to_ns(times)
+    days, ns_of_day = np.divmod(ns, 86400 * 10**9)
+    return days + 2440587.5, ns_of_day / (86400 * 1e9)
+
+# ISO 8601 strings (e.g. 2022-03-02T10:11:12.123456) -> datetime64[ns]
+# Going through an object array lets numpy parse the whole column in C
+def parse_timestamps(timestamps):
+    return np.asarray(timestamps, dtype=object).astype('datetime64[ns]')
+
+def to_ns(times):
+    return np.asarray(times, dtype='datetime64[ns]').view(np.int64)
+
+def from_ns(ns):
+    return np.asarray(ns, dtype=np.int64).view('datetime64[ns]')
+
+# Offsets as timedelta64[ns]: a timedelta, a timedelta64 or a number (or array) of ms
+def as_offset(offset):
+    if isinstance(offset, timedelta):
+        return np.timedelta64(offset // timedelta(microseconds=1), 'us').astype('timedelta64[ns]')
+    offset = np.asarray(offset)
+    if offset.dtype.kind == 'm':
+        return offset.astype('timedelta64[ns]')
+    return np.round(offset * 1e6).astype(np.int64).astype('timedelta64[ns]')
+
+def apply_offset(times, offset):
+    return np.asarray(times, dtype='datetime64[ns]') + as_offset(offset)
+
+def isoformat(times):
+    return np.datetime_as_string(np.asarray(times, dtype='datetime64[ns]'), unit='us')
+
+# Single datetime64 -> python datetime (microsecond precision), for the few places that still need one
+def to_datetime(time):
+    return np.datetime64(time, 'us').astype(datetime)
+
+# Local mean solar time - UTC at a longitude (degrees east)
+def solar_offset(longitude):
+    return np.timedelta64(int(round(longitude / 15 * 3600 * 1e9)), 'ns')
+
+# Observing night of UTC times at a site: the date at local (solar) noon before them, so a night that runs past
+# midnight stays one night
+def observing_night(times, longitude):
+    return (np.asarray(times, dtype='datetime64[ns]') + solar_offset(longitude) - np.timedelta64(12, 'h')).astype('datetime64[D]')
+
+# UTC start (local solar noon) of an observing night
+def night_start(night, longitude):
+    return np.datetime64(night, 'D').astype('datetime64[ns]') + np.timedelta64(12, 'h') - solar_offset(longitude)
@@ -0,0 +1,106 @@
+import glob
+import os
+import numpy as np
+import pandas as pd
+import roo_vs_ephemeris
+
+# Camera timing offset solver
+# Instead of sweeping offsets, the RA/DEC rates of the satellite are worked out from the interpolated ephemeris
+# velocity, and the clock offset (and optionally drift) that best explains the RA/DEC residuals is fitted by
+# linear least squares:
+#   ephemeris(t + offset + drift*(t - t_mid)) - telescope(t) ~ residual(t) + rate(t)*(offset + drift*(t - t_mid)) = 0
+# so the offset has the same sign convention as the offset passed to roo_vs_ephemeris.main().
+
+rate_step = 1.0 # Step (s) along the ephemeris velocity used for the RA/DEC rates
+
+def wrap_degrees(angle):
+    return (angle + 180) % 360 - 180
+
+# Ephemeris RA/DEC (degrees) and their rates (arcsec/s) at the given times
+def ephemeris_rates(interpolator, telescope_datetime, step=rate_step):
+    positions, velocities = interpolator(telescope_datetime, velocity=True)
+    no_samples = len(telescope_datetime)
+    # Earth rotation is picked up by transforming the stepped position at the stepped time
+    stepped_datetime = telescope_datetime + np.timedelta64(int(step * 1e9), 'ns')
+    batch_positions = np.concatenate((positions, positions + velocities * step))
+    batch_datetime = np.concatenate((telescope_datetime, stepped_datetime))
+    ra, dec = roo_vs_ephemeris.transform_batch(batch_positions[:, 0], batch_positions[:, 1], batch_positions[:, 2], batch_datetime, roo_vs_ephemeris.get_obs_location())
+
+    ra_rate = wrap_degrees(ra[no_samples:] - ra[:no_samples]) * 3600 / step
+    dec_rate = (dec[no_samples:] - dec[:no_samples]) * 3600 / step
+    return ra[:no_samples], dec[:no_samples], ra_rate, dec_rate
+
+# Least-squares clock offset (s) and drift (s/s) from RA/DEC residuals and rates (arcsec, arcsec/s)
+# Returns the fitted parameters, their 1-sigma uncertainties and the post-fit RMS (arcsec)
+def solve_offset(ra_residual, dec_residual, ra_rate, dec_rate, times, drift=False):
+    rates = np.concatenate((ra_rate, dec_rate))
+    columns = [rates]
+    if drift:
+        time_from_mid = times - np.mean(times)
+        columns.append(rates * np.concatenate((time_from_mid, time_from_mid)))
+    design = np.column_stack(columns)
+    residuals = -np.concatenate((ra_residual, dec_residual))
+
+    parameters, _, rank, _ = np.linalg.lstsq(design, residuals, rcond=None)
+    if rank < design.shape[1]:
+        raise np.linalg.LinAlgError("Satellite motion doesn't constrain the timing " + ("offset and drift" if drift else "offset"))
+    post_fit = residuals - design @ parameters
+    dof = max(len(residuals) - design.shape[1], 1)
+    variance = post_fit @ post_fit / dof
+    covariance = variance * np.linalg.inv(design.T @ design)
+    sigmas = np.sqrt(np.diag(covariance))
+    return parameters, sigmas, np.sqrt(np.mean(post_fit**2))
+
+# telescope_obs (timestamps, RA, DEC) is read from file if not given; available is the prefetched SP3 files, if any
+def solve_file(file, ephemeris_folder, drift=False, telescope_obs=None, available=None):
+    satellite = roo_vs_ephemeris.file_satellite(file)
+    telescope_datetime, telescope_ra, telescope_dec = roo_vs_ephemeris.read_telescope_file(file) if telescope_obs is None else telescope_obs
+    paths_to_sp3 = roo_vs_ephemeris.choose_ephemerides(roo_vs_ephemeris.ephemeris_type, ephemeris_folder, telescope_datetime.min(), telescope_datetime.max(), available)
+    interpolator = roo_vs_ephemeris.track_interpolator(paths_to_sp3, satellite)
+
+    ephemeris_ra, ephemeris_dec, ra_rate, dec_rate = ephemeris_rates(interpolator, telescope_datetime)
+    ra_residual = wrap_degrees(ephemeris_ra - telescope_ra) * 3600
+    dec_residual = (ephemeris_dec - telescope_dec) * 3600
+    times = (telescope_datetime - telescope_datetime[0]) / np.timedelta64(1, 's')
+    parameters, sigmas, rms = solve_offset(ra_residual, dec_residual, ra_rate, dec_rate, times, drift)
+
+    result = {
+        "File": os.path.basename(file),
+        "Satellite": satellite,
+        "Samples": len(times),
+        "Offset (ms)": parameters[0] * 1000,
+        "Offset Sigma (ms)": sigmas[0] * 1000,
+        "RMS Before (arcsec)": np.sqrt(np.mean(np.concatenate((ra_residual, dec_residual))**2)),
+        "RMS After (arcsec)": rms,
+    }
+    if drift:
+        result["Drift (ppm)"] = parameters[1] * 1e6
+        result["Drift Sigma (ppm)"] = sigmas[1] * 1e6
+    return result
+
+# Fits the timing offset of every observation file in one pass and saves them in <output_file>
+def solve_offsets(ephemeris_folder, telescope_data_folder, output_file, drift=False):
+    results = []
+    telescope_obs = {}
+    for file in sorted(glob.glob(telescope_data_folder + "*.csv")):
+        if roo_vs_ephemeris.file_satellite(file) is None:
+            print("No satellite found in " + os.path.basename(file) + ", skipping")
+            continue
+        telescope_obs[file] = roo_vs_ephemeris.read_telescope_file(file)
+    available = roo_vs_ephemeris.prefetch_observations(roo_vs_ephemeris.ephemeris_type, ephemeris_folder, [(obs[0].min(), obs[0].max()) for obs in telescope_obs.values()])
+
+    for file, obs in telescope_obs.items():
+        try:
+            result = solve_file(file, ephemeris_folder, drift, obs, available)
+        except FileNotFoundError as error:
+            print(str(error) + ", skipping " + os.path.basename(file))
+            continue
+        print(result["File"] + ": offset " + format(result["Offset (ms)"], ".3f") + " +/- " + format(result["Offset Sigma (ms)"], ".3f") + " ms")
+        results.append(result)
+
+    if os.path.dirname(output_file) and not(os.path.isdir(os.path.dirname(output_file))):
+        os.makedirs(os.path.dirname(output_file))
+    results = pd.DataFrame(results)
+    results.to_csv(output_file, index=False)
+    print("Done :D Timing offsets saved in " + output_file + "\n")
+    return results
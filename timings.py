@@ -0,0 +1,93 @@
+import cProfile
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Stage timings for the comparison pipeline
+# With enabled = True, every `with stage(name, samples):` block adds its wall time, CPU time and sample count to a
+# record (a dict of stage -> totals), and emit() writes a record as one JSON line, per file and per run, to log_file
+# (stderr if None). When disabled stage() returns straight away, so the instrumentation costs nothing noticeable.
+# Stages that run on worker processes are timed there (collect()) and merged into the parent's record, so their
+# wall/CPU time is summed over the workers rather than elapsed time.
+
+enabled = False
+log_file = None # JSON lines file to append to
+
+current = {} # Record stages go to when not given one
+lock = threading.Lock() # The streaming reader thread records its stage alongside the main thread
+
+def add(record, name, wall, cpu, samples, calls=1):
+    with lock:
+        totals = record.setdefault(name, [0.0, 0.0, 0, 0])
+        totals[0] += wall
+        totals[1] += cpu
+        totals[2] += samples
+        totals[3] += calls
+
+def merge(record, other):
+    for name, (wall, cpu, samples, calls) in other.items():
+        add(record, name, wall, cpu, samples, calls)
+    return record
+
+# The block can set timed["samples"] if the count is only known inside it
+@contextmanager
+def stage(name, samples=0, record=None):
+    timed = {"samples": samples}
+    if not enabled:
+        yield timed
+        return
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield timed
+    finally:
+        add(current if record is None else record, name, time.perf_counter() - wall, time.process_time() - cpu, timed["samples"])
+
+# Runs function(*args) with the stages it records (that aren't given a record) going to record
+def into(record, function, *args):
+    global current
+    previous, current = current, record
+    try:
+        return function(*args)
+    finally:
+        current = previous
+
+# Runs function(*args) with its stages recorded, returns (result, record); for process pool workers
+def collect(function, *args):
+    global enabled
+    enabled = True
+    record = {}
+    return into(record, function, *args), record
+
+def summary(record):
+    return {name: {"wall_s": round(wall, 6), "cpu_s": round(cpu, 6), "samples": samples, "calls": calls,
+                   "samples_per_s": round(samples / wall, 1) if samples and wall > 0 else None}
+            for name, (wall, cpu, samples, calls) in record.items()}
+
+# One JSON line: {"event": "file"/"run", "time": ..., <fields>, "stages": {stage: totals}}
+def emit(event, record, **fields):
+    if not enabled:
+        return
+    line = json.dumps(dict(event=event, time=datetime.now(timezone.utc).isoformat(timespec="seconds"), **fields, stages=summary(record)))
+    if log_file is None:
+        print(line, file=sys.stderr)
+    else:
+        with open(log_file, "a") as timings_file:
+            timings_file.write(line + "\n")
+
+# cProfile dump of everything run inside the block (the main process only, not pool workers); no-op if path is None
+@contextmanager
+def profile(path):
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print("Profile saved in " + path + " (view with python -m pstats or snakeviz)")